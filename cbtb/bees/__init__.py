@@ -2,3 +2,4 @@
 from locations import summarise_posn_plot
 
 from libcollbehav import volatility, compute_threshold, cdi, cdi_for_period, identify_winner
+from libcollbehav import cdi_sliding, identify_winners
@@ -8,53 +8,109 @@ def vol_step(X, t, n):
     about a population of size n.
 
     '''
-    _X = np.array(X) # X should be list-like but work on a numpy array
+    _X = np.asarray(X) # X should be list-like but work on a numpy array
     if t >= _X.shape[0]-1:
         raise RuntimeError, "cannot compute index past end of array"
 
     v = np.abs(_X[t] - _X[t+1]) / float(n)
     return v
 
-def volatility(X, n):
+def volatility(X, n, block=65536):
     '''
     compute volatility index for entire experimental series X
-    '''
-    _X = np.array(X)
-    t_max = _X.shape[0]
-    _V = np.zeros(t_max-1)
 
-    for t in xrange (t_max-1):
-        _V[t] = vol_step(_X, t, n=n)
-        #print _V[t], _X[t], _X[t+1]
+    X can also be an ensemble (runs x time), to get the index of every run
+    in one call; n is then either one population size, or one per run.
+    Runs are processed `block` at a time, to bound the temporaries.
+    '''
+    _X = np.asarray(X)
+    if _X.ndim == 1:
+        _X = _X.astype(float)
+        return np.abs(np.diff(_X)).sum() / (float(n) * (_X.shape[0] - 1.0))
 
-    return (1.0 / (t_max-1.0) ) * _V.sum()
+    runs, t_max = _X.shape
+    _n = np.broadcast_to(np.asarray(n, dtype=float), (runs,))
+    _V = np.empty((runs,))
+    for a in xrange(0, runs, block):
+        # in float, as integer counts could wrap in diff
+        _B = _X[a:a+block].astype(float)
+        _V[a:a+block] = np.abs(np.diff(_B, axis=1)).sum(axis=1)
+    return _V / (_n * (t_max - 1.0))
 
 def _volatility_onefunc(X,n):
     ''' explicit form above; this does the same thing but harder to read! '''
-    return np.abs(np.ediff1d(X)).sum() / float(n * len(X)-1)
+    return np.abs(np.ediff1d(X)).sum() / (float(n) * (len(X)-1))
+
 
+# memo of compute_threshold, keyed on (n, onesided, pval, prob)
+_THRESHOLDS = {}
+
+def _two_sided_pvals(x, n, prob):
+    '''
+    p-values of stats.binom_test(x, n, prob) for counts x above the mean,
+    in one go: the upper tail from x, plus the lower tail of counts that
+    are no more likely than x.
+    '''
+    rerr = 1 + 1e-7
+    d = stats.binom.pmf(x, n, prob)
+    lower = np.sort(stats.binom.pmf(np.arange(np.floor(prob * n) + 1), n, prob))
+    y = np.searchsorted(lower, d * rerr, side='right')
+    return np.minimum(1.0, stats.binom.cdf(y - 1, n, prob) +
+                      stats.binom.sf(x - 1, n, prob))
+
+def _threshold(n, onesided, pval, prob):
+    L = np.arange(n+1)
+    if onesided:
+        p = stats.binom.sf(L-1, n, p=prob)
+    else:
+        p = np.ones((n+1,))
+        above = L > prob * n
+        p[above] = _two_sided_pvals(L[above], n, prob)
+
+    nz = (p < pval).nonzero()[0]
+    if len(nz):
+        return int(nz[0])
+    else:
+        return -1
 
 def compute_threshold(n, onesided=True, pval=0.05, prob=0.5):
     '''
     for binomial test, at what point is it considered a significant
     cllective decision?
+
+    returns the lowest count (of n) that is significant at level pval, or
+    -1 if there is none.  One-sided, the test is for X >= count; two-sided,
+    the count is the lowest one above the mean that binom_test rejects.
+    Values are memoised, as cdi etc ask for the same n over and over.
     '''
-    # compute in a bit of a clunky way - compute all values until we find
-    # the first level that exceeds the desired p value.
-    ev = np.zeros((n+1,))
-    for i, L in enumerate(xrange(n+1)):
-        if onesided:
-            p = stats.binom.sf(L-1, n, p=prob)
-        else:
-            raise NotImplementedError
-        if p < pval:
-            ev[i] = True
+    key = (int(n), bool(onesided), float(pval), float(prob))
+    if key not in _THRESHOLDS:
+        _THRESHOLDS[key] = _threshold(*key)
+    return _THRESHOLDS[key]
 
-    nz = ev.nonzero()[0]
-    if len(nz):
-        return nz[0]
+def compute_thresholds(ns, onesided=True, pval=0.05, prob=0.5):
+    ''' compute_threshold for each population size in ns, as an array '''
+    _ns = np.asarray(ns)
+    u, inv = np.unique(_ns, return_inverse=True)
+    thr = np.array([compute_threshold(k, onesided=onesided, pval=pval,
+                                      prob=prob) for k in u], dtype=int)
+    return thr[inv].reshape(_ns.shape)
+
+def collective_decisions(X, n):
+    '''
+    boolean array, True where the count in X (of n animals) is a
+    significant collective decision to either side.  X is a 1d series, or
+    an ensemble (runs x time) with one n or one per run.
+    '''
+    _X = np.asarray(X) # work on a numpy array for logic operators
+    if _X.ndim == 1:
+        thr_upper = compute_threshold(n)
+        thr_lower = n - thr_upper
     else:
-        return -1
+        _n = np.broadcast_to(np.asarray(n), (_X.shape[0],))
+        thr_upper = compute_thresholds(_n)[:, None]
+        thr_lower = _n[:, None] - thr_upper
+    return ((_X >= thr_upper) | (_X <= thr_lower))
 
 def cdi(X, n):
     '''
@@ -62,38 +118,132 @@ def cdi(X, n):
     on one side of a binary collective choice assay:
     compute the collective decision index
 
+    X can also be an ensemble (runs x time), with one n or one per run;
+    the index of each run is returned.
     '''
-    # compute upper and lower thresholds.
-    thr_upper = compute_threshold(n)
-    thr_lower = n - thr_upper
-
-    _X = np.array(X) # work on a numpy array for logic operators
-    coll_decns = ((_X >= thr_upper) | (_X <= thr_lower))
-
-    return coll_decns.mean()
+    coll_decns = collective_decisions(X, n)
+    return coll_decns.mean(axis=-1)
 
 def cdi_for_period(X, n, period_late_mins=10.0, dt=1.0):
     '''
     compute the collective decision index in data series for last plm mins
 
     X   1d time series of fraction decided to majority side.?
+        (or an ensemble, runs x time, as for cdi)
     ##ts  time indications, in sec
     plm duration to look for
     dt  sample interval in X ## (derivable from ts as well)
     '''
     samples_in_decn_period = int(period_late_mins * 60.0 / dt)
 
-    # compute upper and lower thresholds.
-    thr_upper = compute_threshold(n)
-    thr_lower = n - thr_upper
+    coll_decns = collective_decisions(X, n)
+    cd_period = coll_decns[..., -samples_in_decn_period:]
+    return cd_period.mean(axis=-1)
 
-    _X = np.array(X) # work on a numpy array for logic operators
-    coll_decns = ((_X >= thr_upper) | (_X <= thr_lower))
+def cdi_sliding(X, n, period_mins=10.0, dt=1.0, block=8192):
+    '''
+    time course of the collective decision index: at each sample, the cdi
+    over the preceding period_mins (or as much of it as there is, at the
+    start).  O(T) per run, from a cumulative count of decisions.
 
-    cd_period = coll_decns[-samples_in_decn_period:]
-    return cd_period.mean()
+    X is a 1d series or an ensemble (runs x time), as for cdi; the result
+    has the same shape.
+    '''
+    w = max(int(period_mins * 60.0 / dt), 1)
+    _X = np.asarray(X)
+    _2d = np.atleast_2d(_X)
+    runs, t_max = _2d.shape
+    _n = np.broadcast_to(np.asarray(n), (runs,))
+    # samples in each window: 1, 2, .. w, w, w ...
+    cnt = np.minimum(np.arange(1, t_max + 1), w).astype(float)
+
+    out = np.empty((runs, t_max))
+    for a in xrange(0, runs, block):
+        cs = np.zeros((min(block, runs - a), t_max + 1), dtype=np.int32)
+        np.cumsum(collective_decisions(_2d[a:a+block], _n[a:a+block]),
+                  axis=1, out=cs[:, 1:])
+        lo = np.maximum(np.arange(1, t_max + 1) - w, 0)
+        out[a:a+block] = (cs[:, 1:] - cs[:, lo]) / cnt
+    return out.reshape(_X.shape)
+
+
+
+# statistics that null_distribution knows by name
+NULL_STATS = {
+    'cdi': cdi,
+    'cdi_for_period': cdi_for_period,
+    'volatility': volatility,
+}
+
+def null_distribution(stat, n, T, prob=0.5, reps=10000, seed=None,
+                      max_elems=1<<22, **kwargs):
+    '''
+    Monte Carlo distribution of a statistic under independent behaviour:
+    `reps` runs of T samples, each sample a binomial(n, prob) count.
+    stat is 'cdi', 'cdi_for_period', 'volatility' or any f(X, n) taking an
+    ensemble; kwargs are passed on to it (e.g. period_late_mins, dt).
+
+    Runs are drawn as (runs x T) arrays of at most max_elems samples, so
+    memory is bounded whatever `reps` is; seed is an int or a RandomState,
+    and the values do not depend on max_elems.
+
+    returns the sorted values, for null_quantiles / null_pvalue.
+    '''
+    fn = NULL_STATS.get(stat, stat)
+    if isinstance(seed, np.random.RandomState):
+        rs = seed
+    else:
+        rs = np.random.RandomState(seed)
 
+    rows = max(1, int(max_elems // T))
+    null = np.empty((reps,))
+    for a in xrange(0, reps, rows):
+        k = min(rows, reps - a)
+        null[a:a+k] = fn(rs.binomial(n, prob, size=(k, T)), n, **kwargs)
+    null.sort()
+    return null
 
+def null_quantiles(null, q=(0.025, 0.5, 0.975)):
+    ''' quantiles of a null distribution (q in 0..1) '''
+    return np.percentile(null, 100.0 * np.asarray(q))
+
+def null_pvalue(null, observed, tail='greater'):
+    '''
+    Monte Carlo p-values of observed value(s), against the sorted null from
+    null_distribution: (1 + #null at least as extreme) / (1 + #null).
+    tail is 'greater' (e.g. cdi), 'less' (e.g. volatility, which is high
+    for independent behaviour) or 'two-sided'.
+    '''
+    _obs = np.asarray(observed, dtype=float)
+    reps = len(null)
+    n_ge = reps - np.searchsorted(null, _obs, side='left')
+    n_le = np.searchsorted(null, _obs, side='right')
+    if tail == 'greater':
+        count = n_ge
+    elif tail == 'less':
+        count = n_le
+    elif tail == 'two-sided':
+        return np.minimum(1.0, 2.0 * (1.0 + np.minimum(n_ge, n_le)) / (1.0 + reps))
+    else:
+        raise ValueError("unknown tail '{}'".format(tail))
+    return (1.0 + count) / (1.0 + reps)
+
+def sample_interval(t, resolution=None):
+    '''
+    the most frequent (positive) interval between the timestamps t.
+
+    By default this is exact, the same as stats.mode (the smallest of any
+    tied values) but from one sort.  With a resolution (e.g. 0.001 s), the
+    intervals are binned to multiples of it and counted with bincount,
+    which is faster still.
+    '''
+    _dt = np.ediff1d(t)
+    _dt = _dt[_dt > 0]
+    if resolution is None:
+        u, counts = np.unique(_dt, return_counts=True)
+        return float(u[np.argmax(counts)])
+    bins = np.round(_dt / resolution).astype(np.int64)
+    return float(np.argmax(np.bincount(bins)) * resolution)
 
 def identify_winner(d, nbees, period_late_mins):
     '''
@@ -101,9 +251,7 @@ def identify_winner(d, nbees, period_late_mins):
     the final args.period_late_mins
     '''
     # verify the most frequent interval among samples
-    _dt = np.ediff1d(d[:,0])
-    interval = float( stats.mode( _dt[_dt>0]).mode.mean())
-    #interval = float(stats.mode(np.ediff1d(d[:,0]))[0])
+    interval = sample_interval(d[:,0])
 
     # decide which side won.
     samples_in_decn_period = int(period_late_mins * 60.0 / interval)
@@ -120,3 +268,223 @@ def identify_winner(d, nbees, period_late_mins):
         winfrac = d[:,2] / float(nbees)
 
     return winner, winfrac
+
+def identify_winners(ds, nbees, period_late_mins, dt=None, resolution=None):
+    '''
+    identify_winner for many experiments at once.  ds is a list of
+    (samples, 3) arrays of t, L, R (of any lengths), or one (experiments,
+    samples, 3) array; nbees is one population size or one per experiment.
+    The sample interval is estimated per experiment (see sample_interval)
+    unless dt is given.
+
+    returns
+      winners  array of 'L' / 'R'
+      winfrac  the winning side's fraction over time, for each experiment
+               (a list, or an array if ds was one)
+      margin   (winner - loser) mean count over the final period, / nbees
+    '''
+    lens = np.array([len(d) for d in ds])
+    E = len(lens)
+    _nb = np.broadcast_to(np.asarray(nbees, dtype=float), (E,))
+    if dt is None:
+        interval = np.array([sample_interval(d[:,0], resolution) for d in ds])
+    else:
+        interval = np.broadcast_to(np.asarray(dt, dtype=float), (E,))
+
+    # the final period of each experiment, with d[-k:] semantics
+    k = (period_late_mins * 60.0 / interval).astype(int)
+    start = np.where((k <= 0) | (k >= lens), 0, lens - k)
+
+    # sums of L and R over [start, len) of each one, on the flattened data
+    flat = np.concatenate([np.asarray(d, dtype=float) for d in ds] +
+                          [np.zeros((1, 3))])
+    offs = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    idx = np.column_stack((offs + start, offs + lens)).ravel()
+    late = np.add.reduceat(flat[:, 1:3], idx, axis=0)[::2]
+    late /= (lens - start)[:, None]
+
+    is_R = late[:,1] > late[:,0]
+    winners = np.where(is_R, "R", "L")
+    margin = np.abs(late[:,1] - late[:,0]) / _nb
+
+    col = np.repeat(np.where(is_R, 2, 1), lens)
+    wf = flat[np.arange(len(col)), col] / np.repeat(_nb, lens)
+    winfrac = np.split(wf, np.cumsum(lens)[:-1])
+    if isinstance(ds, np.ndarray):
+        winfrac = np.array(winfrac)
+    return winners, winfrac, margin
+
+# streaming versions: update with one sample at a time, in O(1), without
+# keeping the series.  a.merge(b) combines the state of a chunk b that
+# follows chunk a in time, so chunks can be processed in parallel.
+
+class _RingSum(object):
+    ''' the last k rows of a stream, with their column sums '''
+    def __init__(self, k, ncols=1):
+        self.k = k
+        self.buf = np.zeros((k, ncols))
+        self.sums = np.zeros((ncols,))
+        self.pos = 0
+        self.seen = 0
+
+    def __len__(self):
+        return min(self.seen, self.k)
+
+    def push(self, row):
+        if self.seen >= self.k:
+            self.sums -= self.buf[self.pos]
+        self.buf[self.pos] = row
+        self.sums += self.buf[self.pos]
+        self.pos = (self.pos + 1) % self.k
+        self.seen += 1
+
+    def tail(self):
+        ''' the rows held, oldest first '''
+        return np.roll(self.buf, -self.pos, axis=0)[self.k - len(self):]
+
+    def merge(self, later):
+        rows = np.concatenate([self.tail(), later.tail()])[-self.k:]
+        self.buf[:len(rows)] = rows
+        self.sums = rows.sum(axis=0)
+        self.pos = len(rows) % self.k
+        self.seen += later.seen
+        return self
+
+class CdiAccumulator(object):
+    '''
+    cdi of a series of counts (of n animals), updated a sample at a time
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.thr_upper = compute_threshold(n)
+        self.thr_lower = n - self.thr_upper
+        self.decided = 0
+        self.count = 0
+
+    def is_decision(self, x):
+        return x >= self.thr_upper or x <= self.thr_lower
+
+    def update(self, x):
+        self.decided += self.is_decision(x)
+        self.count += 1
+
+    def value(self):
+        if not self.count:
+            return np.nan
+        return self.decided / float(self.count)
+
+    def merge(self, later):
+        self.decided += later.decided
+        self.count += later.count
+        return self
+
+class CdiPeriodAccumulator(CdiAccumulator):
+    '''
+    cdi_for_period, updated a sample at a time: the decisions of the last
+    period_late_mins are kept in a ring buffer.
+    '''
+    def __init__(self, n, period_late_mins=10.0, dt=1.0):
+        super(CdiPeriodAccumulator, self).__init__(n)
+        k = int(period_late_mins * 60.0 / dt)
+        # as X[-0:] in cdi_for_period, a zero-length period is everything
+        self.late = _RingSum(k) if k > 0 else None
+
+    def update(self, x):
+        if self.late is None:
+            return super(CdiPeriodAccumulator, self).update(x)
+        self.late.push(self.is_decision(x))
+
+    def value(self):
+        if self.late is None:
+            return super(CdiPeriodAccumulator, self).value()
+        if not len(self.late):
+            return np.nan
+        return self.late.sums[0] / float(len(self.late))
+
+    def merge(self, later):
+        if self.late is None:
+            return super(CdiPeriodAccumulator, self).merge(later)
+        self.late.merge(later.late)
+        return self
+
+class VolatilityAccumulator(object):
+    '''
+    volatility of a series of counts (of n animals), updated a sample at a
+    time
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.first, self.last = None, None
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, x):
+        if self.count:
+            self.total += abs(x - self.last)
+        else:
+            self.first = x
+        self.last = x
+        self.count += 1
+
+    def value(self):
+        if self.count < 2:
+            return np.nan
+        return self.total / (float(self.n) * (self.count - 1))
+
+    def merge(self, later):
+        if not later.count:
+            return self
+        if not self.count:
+            self.first = later.first
+        else:
+            self.total += abs(later.first - self.last)
+        self.total += later.total
+        self.last = later.last
+        self.count += later.count
+        return self
+
+class WinnerAccumulator(object):
+    '''
+    identify_winner, updated a sample (L, R) at a time.  The sample
+    interval dt must be known, to size the final period.  Rather than the
+    win fraction series, the mean fraction of each side is kept.
+    '''
+    def __init__(self, nbees, period_late_mins, dt=1.0):
+        self.nbees = nbees
+        k = int(period_late_mins * 60.0 / dt)
+        # the final period; everything if zero-length (as d[-0:])
+        self.late = _RingSum(k, 2) if k > 0 else None
+        self.totals = np.zeros((2,))
+        self.count = 0
+
+    def update(self, L, R):
+        self.totals += (L, R)
+        self.count += 1
+        if self.late is not None:
+            self.late.push((L, R))
+
+    def _late_means(self):
+        if self.late is None:
+            return self.totals / float(self.count)
+        return self.late.sums / float(len(self.late))
+
+    def winner(self):
+        L, R = self._late_means()
+        return "R" if R > L else "L"
+
+    def margin(self):
+        ''' (winner - loser) mean count over the final period, / nbees '''
+        L, R = self._late_means()
+        return abs(R - L) / float(self.nbees)
+
+    def mean_winfrac(self):
+        ''' mean fraction on the winning side, over the whole series '''
+        i = 1 if self.winner() == "R" else 0
+        return self.totals[i] / float(self.count * self.nbees)
+
+    def merge(self, later):
+        self.totals += later.totals
+        self.count += later.count
+        if self.late is not None:
+            self.late.merge(later.late)
+        return self
@@ -0,0 +1,399 @@
+'''
+Native (NumPy) information-theoretic calculators, with the same interface
+as the JIDT calculators used in libinfo, so they can be passed to
+slide_te_grp without a JVM:
+
+    calc.setProperty("DELAY", "2"); calc.setProperty("k_HISTORY", "1")
+    calc.initialise()
+    calc.startAddObservations()
+    for src, dst in zip(D1, D2):        # one call per series of an ensemble
+        calc.addObservations(src, dst)
+    calc.finaliseAddObservations()
+    te = calc.computeAverageLocalOfObservations()       # nats
+    p = calc.computeSignificance(100).pValue
+
+The observations are embedded as JIDT does: for transfer entropy from Y
+to X with histories k, l (spacing k_tau, l_tau) and source-target DELAY
+u, each observation of a series is
+    x_{t+1};  (x_t, .., x_{t-(k-1)k_tau});  (y_{t+1-u}, .., y_{t+1-u-(l-1)l_tau})
+and TE is the conditional mutual information I(Y_past ; X_next | X_past).
+For mutual information, with TIME_DIFF d, the pairs are (y_t, x_{t+d}).
+
+**TransferEntropyCalculatorGaussian**, **MutualInfoCalculatorGaussian**
+Linear-Gaussian estimators, from the covariance of the observations: e.g.
+I(A;B|C) = 1/2 ln( |S_AC| |S_BC| / (|S_C| |S_ABC|) ).
+
+**TransferEntropyCalculatorKraskov**, **MutualInfoCalculatorKraskov**
+Nearest-neighbour (KSG) estimators, Kraskov et al (2004) algorithm 1 or 2
+(property ALG_NUM), with Frenzel & Pompe (2007) for the conditional MI in
+TE.  Properties as JIDT: k (neighbours, default 4), NORMALISE,
+NOISE_LEVEL_TO_ADD (to break ties in count data) and NUM_THREADS.  Needs
+scipy; the neighbour searches are batched over all observations in a
+cKDTree, using NUM_THREADS cores.
+
+computeSignificance permutes the source observations, as JIDT does.
+'''
+
+import itertools
+from distutils.version import LooseVersion
+import numpy as np
+
+try:
+    import scipy
+    from scipy.spatial import cKDTree
+    from scipy.special import digamma
+    # the thread count argument of cKDTree queries was renamed in 1.6
+    _JOBS_ARG = 'workers' if LooseVersion(scipy.__version__) >= LooseVersion('1.6') \
+        else 'n_jobs'
+except ImportError:
+    cKDTree = None
+
+#{{{ significance result
+class EmpiricalDistribution(object):
+    '''
+    result of computeSignificance, with the fields used from JIDT's
+    EmpiricalMeasurementDistribution
+    '''
+    def __init__(self, distribution, actualValue):
+        self.distribution = np.asarray(distribution)
+        self.actualValue = actualValue
+        # proportion of surrogates at least as large as the actual value
+        self.pValue = np.mean(self.distribution >= actualValue) \
+            if len(self.distribution) else 1.0
+
+    def getMeanOfDistribution(self):
+        return self.distribution.mean()
+
+    def getStdOfDistribution(self):
+        return self.distribution.std()
+#}}}
+
+#{{{ embedding and observation handling
+def _as_2d(x):
+    x = np.asarray(x, dtype=float)
+    return x[:, None] if x.ndim == 1 else x
+
+def _embed(x, dim, tau, first, num):
+    '''
+    delay vectors of x (1d) with `dim` points spaced `tau`, for the key
+    times first .. first+num-1: row t is x[t], x[t-tau], ..
+    '''
+    idx = first + np.arange(num)[:, None] - tau * np.arange(dim)[None, :]
+    return x[idx]
+
+class _Calculator(object):
+    '''
+    properties, ensemble observations and significance testing shared by
+    the calculators.  Subclasses give _observe (series -> A, B, C blocks)
+    and _estimate (I(A;B|C) over blocks).
+    '''
+    defaults = {}
+
+    def __init__(self, seed=None):
+        self.props = {}
+        for cls in reversed(type(self).__mro__):
+            self.props.update(cls.__dict__.get('defaults', {}))
+        self.rs = seed if isinstance(seed, np.random.RandomState) \
+            else np.random.RandomState(seed)
+        self.initialise()
+
+    def setProperty(self, name, value):
+        self.props[name] = str(value)
+
+    def getProperty(self, name):
+        return self.props.get(name)
+
+    def _int(self, name):
+        return int(self.props[name])
+
+    def initialise(self, *args):
+        self._blocks = []
+        self.A = self.B = self.C = None
+        self.lastAverage = None
+
+    def startAddObservations(self):
+        self._blocks = []
+
+    def addObservations(self, source, destination):
+        obs = self._observe(np.asarray(source, dtype=float),
+                            np.asarray(destination, dtype=float))
+        if obs is not None and len(obs[0]):
+            self._blocks.append(obs)
+
+    def finaliseAddObservations(self):
+        if not len(self._blocks):
+            raise RuntimeError("no observations were added (series too short?)")
+        self.A, self.B, self.C = [np.concatenate(b) for b in zip(*self._blocks)]
+        self._blocks = []
+
+    def setObservations(self, source, destination):
+        self.startAddObservations()
+        self.addObservations(source, destination)
+        self.finaliseAddObservations()
+
+    def getNumObservations(self):
+        return 0 if self.A is None else len(self.A)
+
+    def computeAverageLocalOfObservations(self):
+        self.lastAverage = self._estimate(self.A, self.B, self.C)
+        return self.lastAverage
+
+    def _surrogates(self, perms):
+        return np.array([self._estimate(self.A[p], self.B, self.C) for p in perms])
+
+    def computeSignificance(self, numPermutationsToCheck):
+        '''
+        distribution of the measure with the source observations shuffled,
+        and the p-value of the actual measure against it
+        '''
+        if self.lastAverage is None:
+            self.computeAverageLocalOfObservations()
+        N = self.getNumObservations()
+        perms = [self.rs.permutation(N) for _ in xrange(int(numPermutationsToCheck))]
+        return EmpiricalDistribution(self._surrogates(perms), self.lastAverage)
+
+class _TransferEntropyObs(object):
+    ''' TE observations, embedded as JIDT's TE calculators do '''
+    defaults = {'k_HISTORY': '1', 'k_TAU': '1', 'l_HISTORY': '1',
+                'l_TAU': '1', 'DELAY': '1'}
+
+    def initialise(self, *args):
+        # initialise(k) or initialise(k, k_tau, l, l_tau, delay)
+        for name, v in zip(['k_HISTORY', 'k_TAU', 'l_HISTORY', 'l_TAU',
+                            'DELAY'], args):
+            self.setProperty(name, v)
+        super(_TransferEntropyObs, self).initialise()
+
+    def _observe(self, source, destination):
+        k, k_tau = self._int('k_HISTORY'), self._int('k_TAU')
+        l, l_tau = self._int('l_HISTORY'), self._int('l_TAU')
+        delay = self._int('DELAY')
+        first = max((k - 1) * k_tau, (l - 1) * l_tau + delay - 1)
+        num = len(destination) - first - 1
+        if num <= 0:
+            return None
+        dest_past = _embed(destination, k, k_tau, first, num)
+        dest_next = _embed(destination, 1, 1, first + 1, num)
+        src_past = _embed(source, l, l_tau, first + 1 - delay, num)
+        return src_past, dest_next, dest_past
+
+class _MutualInfoObs(object):
+    ''' MI observations (source_t, destination_{t+TIME_DIFF}) '''
+    defaults = {'TIME_DIFF': '0'}
+
+    def _observe(self, source, destination):
+        d = self._int('TIME_DIFF')
+        source, destination = _as_2d(source), _as_2d(destination)
+        num = min(len(source), len(destination) - d)
+        if d < 0 or num <= 0:
+            return None
+        return (source[:num], destination[d:d + num],
+                np.zeros((num, 0)))
+#}}}
+
+#{{{ linear-Gaussian estimators
+def _logdet(S, idx):
+    if not len(idx):
+        return 0.0
+    return np.linalg.slogdet(S[np.ix_(idx, idx)])[1]
+
+def _gaussian_cmi(S, a, b, c):
+    ''' I(A;B|C) in nats, from the joint covariance S of [A B C] '''
+    return 0.5 * (_logdet(S, a + c) + _logdet(S, b + c)
+                  - _logdet(S, c) - _logdet(S, a + b + c))
+
+class _GaussianCalculator(_Calculator):
+    def _blocks_idx(self, A, B, C):
+        na, nb, nc = A.shape[1], B.shape[1], C.shape[1]
+        return (range(na), range(na, na + nb), range(na + nb, na + nb + nc))
+
+    def _scatter(self, A, B, C):
+        # (unnormalised) covariance; the scale cancels in _gaussian_cmi
+        Z = np.hstack((A, B, C))
+        Z = Z - Z.mean(axis=0)
+        return Z, Z.T.dot(Z)
+
+    def _estimate(self, A, B, C):
+        Z, S = self._scatter(A, B, C)
+        return _gaussian_cmi(S, *self._blocks_idx(A, B, C))
+
+    def _surrogates(self, perms):
+        # only the covariances between the source and the rest change
+        a, b, c = self._blocks_idx(self.A, self.B, self.C)
+        Z, S = self._scatter(self.A, self.B, self.C)
+        Za, Zr = Z[:, a], Z[:, len(a):]
+        out = np.empty((len(perms),))
+        for i, p in enumerate(perms):
+            cross = Za[p].T.dot(Zr)
+            S[np.ix_(a, b + c)] = cross
+            S[np.ix_(b + c, a)] = cross.T
+            out[i] = _gaussian_cmi(S, a, b, c)
+        return out
+
+class TransferEntropyCalculatorGaussian(_TransferEntropyObs, _GaussianCalculator):
+    ''' linear-Gaussian transfer entropy, as JIDT's class of the same name '''
+    pass
+
+class MutualInfoCalculatorGaussian(_MutualInfoObs, _GaussianCalculator):
+    '''
+    linear-Gaussian mutual information, as JIDT's
+    MutualInfoCalculatorMultiVariateGaussian
+    '''
+    pass
+#}}}
+
+#{{{ nearest-neighbour (KSG) estimators
+def _ball_pairs(X, r, strict, jobs):
+    '''
+    pairs (i, j), j != i, with max-norm |X_j - X_i| < r_i (<= unless
+    strict), as arrays per group of points.  Points of similar radius are
+    queried together at the group's largest radius, then trimmed to their own.
+    '''
+    tree = cKDTree(X)
+    grp = np.floor(4 * np.log2(np.maximum(r, 1e-300)))
+    order = np.argsort(grp, kind='mergesort')
+    for sel in np.split(order, np.flatnonzero(np.diff(grp[order])) + 1):
+        lists = tree.query_ball_point(X[sel], r[sel].max(), p=np.inf,
+                                      **{_JOBS_ARG: jobs})
+        lens = np.fromiter((len(l) for l in lists), int, len(sel))
+        j = np.fromiter(itertools.chain.from_iterable(lists), int, lens.sum())
+        i = np.repeat(sel, lens)
+        d = np.abs(X[j] - X[i]).max(axis=1)
+        keep = ((d < r[i]) if strict else (d <= r[i])) & (i != j)
+        yield i[keep], j[keep]
+
+_INT64_MIN = np.int64(-2**63)
+
+def _float_key(v):
+    ''' float64 -> int64 keys in the same order (adjacent floats differ by 1) '''
+    i = np.asarray(v, dtype=float).view(np.int64)
+    return np.where(i < 0, _INT64_MIN - i, i)
+
+def _key_float(k):
+    return np.where(k < 0, _INT64_MIN - k, k).view(float)
+
+def _edge(guess, scale, turned):
+    '''
+    the smallest float where the test turned(v) (monotone in v, per
+    element) becomes True, bisected over the floats within about `scale`
+    of the guess
+    '''
+    w = 4 * np.spacing(scale)
+    lo, hi = guess - w, guess + w
+    m = turned(lo) | ~turned(hi)
+    while m.any():
+        w[m] *= 2
+        lo, hi = np.where(m, guess - w, lo), np.where(m, guess + w, hi)
+        m = turned(lo) | ~turned(hi)
+    lo, hi = _float_key(lo), _float_key(hi)
+    while (hi - lo > 1).any():
+        mid = lo + (hi - lo) // 2
+        t = turned(_key_float(mid))
+        lo, hi = np.where(t, lo, mid), np.where(t, mid, hi)
+    return _key_float(hi)
+
+def _count_1d(x, r, strict):
+    '''
+    _count for 1d x, by binary search in sorted x.  The search bounds are
+    the exact floats where |x_j - x_i| < r_i (or <=) changes, as the k-NN
+    distances were computed: bisected within a few ulps of x_i +- r_i, so
+    the cost does not depend on ties in x.
+    '''
+    inside = (lambda d: d < r) if strict else (lambda d: d <= r)
+    xs = np.sort(x)
+    # hi: number of x_j with x_j - x_i inside; lo: number with x_i - x_j not
+    scale = np.maximum(np.abs(x), r)
+    hi = np.searchsorted(xs, _edge(x + r, scale, lambda v: ~inside(v - x)), side='left')
+    lo = np.searchsorted(xs, _edge(x - r, scale, lambda v: inside(x - v)), side='left')
+    return np.maximum(hi - lo, 0) - inside(0.0)
+
+def _count(X, r, strict, jobs):
+    ''' number of other points within r_i of each point i of X '''
+    if X.shape[1] == 1:
+        return _count_1d(X[:, 0], r, strict)
+    n = np.zeros(len(X), dtype=int)
+    for i, j in _ball_pairs(X, r, strict, jobs):
+        n += np.bincount(i, minlength=len(X))
+    return n
+
+def _spread(X, nn):
+    ''' max-norm distance in X from each point to the furthest of its nn '''
+    return np.abs(X[nn] - X[:, None, :]).max(axis=2).max(axis=1)
+
+def _ksg_cmi(A, B, C, k, alg, jobs):
+    ''' KSG estimate of I(A;B|C) (or I(A;B) if C has no columns), in nats '''
+    N = len(A)
+    if N <= k:
+        raise ValueError("[E] need more than k={} observations, have {}".format(k, N))
+    J = np.hstack((A, B, C))
+    dist, nn = cKDTree(J).query(J, k + 1, p=np.inf, **{_JOBS_ARG: jobs})
+    nn = nn[:, 1:]   # drop the point itself
+    cond = C.shape[1] > 0
+
+    if alg == 1:
+        eps = dist[:, k]
+        if not cond:
+            na = _count(A, eps, True, jobs)
+            nb = _count(B, eps, True, jobs)
+            return digamma(k) + digamma(N) - np.mean(digamma(na + 1) + digamma(nb + 1))
+        nac = _count(np.hstack((A, C)), eps, True, jobs)
+        nbc = _count(np.hstack((B, C)), eps, True, jobs)
+        nc = _count(C, eps, True, jobs)
+        return digamma(k) - np.mean(digamma(nac + 1) + digamma(nbc + 1) - digamma(nc + 1))
+
+    if alg != 2:
+        raise ValueError("[E] ALG_NUM must be 1 or 2, not {}".format(alg))
+    ea, eb = _spread(A, nn), _spread(B, nn)
+    if not cond:
+        na = _count(A, ea, False, jobs)
+        nb = _count(B, eb, False, jobs)
+        return digamma(k) - 1.0 / k + digamma(N) - np.mean(digamma(na) + digamma(nb))
+    # neighbours in C within eps_c, and of those, within eps_a / eps_b in A / B
+    ec = _spread(C, nn)
+    nc, nac, nbc = [np.zeros(N, dtype=int) for _ in xrange(3)]
+    for i, j in _ball_pairs(C, ec, False, jobs):
+        nc += np.bincount(i, minlength=N)
+        nac += np.bincount(i[np.abs(A[j] - A[i]).max(axis=1) <= ea[i]], minlength=N)
+        nbc += np.bincount(i[np.abs(B[j] - B[i]).max(axis=1) <= eb[i]], minlength=N)
+    return digamma(k) - 2.0 / k + np.mean(digamma(nc) - digamma(nac) - digamma(nbc)
+                                          + 1.0 / nac + 1.0 / nbc)
+
+class _KSGCalculator(_Calculator):
+    defaults = {'k': '4', 'ALG_NUM': '1', 'NORMALISE': 'true',
+                'NOISE_LEVEL_TO_ADD': '1e-8', 'NUM_THREADS': 'USE_ALL'}
+
+    def _jobs(self):
+        v = self.props['NUM_THREADS']
+        return -1 if v.upper() == 'USE_ALL' else int(v)
+
+    def _condition(self, X):
+        # as JIDT: each variable to unit variance, then a little noise
+        X = np.array(X, dtype=float)
+        if self.props['NORMALISE'].lower() == 'true' and len(X):
+            sd = X.std(axis=0)
+            X = (X - X.mean(axis=0)) / np.where(sd > 0, sd, 1.0)
+        noise = float(self.props['NOISE_LEVEL_TO_ADD'])
+        if noise > 0:
+            X += noise * self.rs.randn(*X.shape)
+        return X
+
+    def finaliseAddObservations(self):
+        super(_KSGCalculator, self).finaliseAddObservations()
+        self.A, self.B, self.C = [self._condition(X) for X in (self.A, self.B, self.C)]
+
+    def _estimate(self, A, B, C):
+        if cKDTree is None:
+            raise ImportError("[E] the KSG estimators need scipy")
+        return _ksg_cmi(A, B, C, self._int('k'), self._int('ALG_NUM'), self._jobs())
+
+class TransferEntropyCalculatorKraskov(_TransferEntropyObs, _KSGCalculator):
+    ''' KSG transfer entropy, as JIDT's class of the same name '''
+    pass
+
+class MutualInfoCalculatorKraskov(_MutualInfoObs, _KSGCalculator):
+    '''
+    KSG mutual information, as JIDT's MutualInfoCalculatorMultiVariateKraskov1
+    (or ..Kraskov2, with ALG_NUM 2)
+    '''
+    pass
+#}}}
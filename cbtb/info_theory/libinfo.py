@@ -2,51 +2,91 @@
 Wrappers for JIDT toolbox, using python interface.  Used to apply
 transfer entropy and mutual information calculations, on ensemble data
 series.
+
+Without jpype (or the JIDT jar), the calculators come from the native
+estimators module instead, which has the same interface; set
+backend='numpy' in the prep_* functions to use those regardless.
 '''
-import jpype, sys
+import sys
 import os.path
 
 import numpy as np
 
+try:
+    import jpype
+except ImportError:
+    jpype = None
+
+import estimators
+
 # JIDT requires that the location of the JAR file is on the python path.
 # I have it here..
 sys.path.append( os.path.expanduser("~/projects/build-jidt/jidt/demos/python"))
 jarLocation = os.path.expanduser("~/projects/build-jidt/infodynamics.jar")
 
 #{{{ java toolbox setup
+def have_jidt():
+    ''' can the JIDT calculators be used here? '''
+    return jpype is not None and os.path.exists(jarLocation)
+
+def _use_jidt(backend):
+    if backend is None:
+        return have_jidt()
+    if backend not in ['jidt', 'numpy']:
+        raise ValueError("[E] unknown backend '{}' (jidt or numpy)".format(backend))
+    if backend == 'jidt' and not have_jidt():
+        raise ImportError("[E] the JIDT backend needs jpype and {}".format(jarLocation))
+    return backend == 'jidt'
+
 def init_jvm(jvmpath=None):
     if jpype.isJVMStarted():
         return
     jpype.startJVM(jpype.getDefaultJVMPath())
 
 # taken from jidt code gdnerator
-def prep_jidt():
+def prep_jidt(backend=None):
+    '''
+    start the JVM with JIDT on its class path, if that backend is in use.
+    returns True if JIDT is ready, False if the native calculators are used.
+    '''
+    if not _use_jidt(backend):
+        return False
     # Add JIDT jar library to the path
     # Start the JVM (add the "-Xmx" option with say 1024M if you get crashes due to not enough memory space)
     if not jpype.isJVMStarted(): # cope with ipython restart.
         jpype.startJVM(jpype.getDefaultJVMPath(), "-ea", "-Djava.class.path=" + jarLocation)
+    return True
 
 #}}}
 #{{{ handles to java class initialisers
-def prep_ksg():
+def prep_ksg(backend=None):
+    if not prep_jidt(backend):
+        calc = estimators.MutualInfoCalculatorKraskov()
+        calc.setProperty("ALG_NUM", "2")
+        return calc
     calcClass = jpype.JPackage("infodynamics.measures.continuous.kraskov").MutualInfoCalculatorMultiVariateKraskov2
     calc = calcClass()
     return calc
 
-def prep_MoG():
+def prep_MoG(backend=None):
+    if not prep_jidt(backend):
+        return estimators.MutualInfoCalculatorGaussian()
     calcClass = jpype.JPackage("infodynamics.measures.continuous.gaussian").MutualInfoCalculatorMultiVariateGaussian
     return calcClass()
 
-def prep_te_ksg():
+def prep_te_ksg(backend=None):
+    if not prep_jidt(backend):
+        return estimators.TransferEntropyCalculatorKraskov()
     calcClass = jpype.JPackage("infodynamics.measures.continuous.kraskov").TransferEntropyCalculatorKraskov
     return calcClass()
 
-def prep_te_MoG():
+def prep_te_MoG(backend=None):
+    if not prep_jidt(backend):
+        return estimators.TransferEntropyCalculatorGaussian()
     calcClass = jpype.JPackage("infodynamics.measures.continuous.gaussian").TransferEntropyCalculatorGaussian
     return calcClass()
 
 #}}}
-
 #{{{ slide_te_grp
 def slide_te_grp(calc, lrng, D1, D2, samples=100, verb=False, prop="DELAY" , k=1, l=1):
     '''
@@ -54,7 +94,8 @@ def slide_te_grp(calc, lrng, D1, D2, samples=100, verb=False, prop="DELAY" , k=1
     for several time delays or lags, as defiend in the list `lrng` (integers).
     D1 and D2 are expected to be ensembles.
 
-    `calc` should be a transfer entropy object of JIDT
+    `calc` should be a transfer entropy object of JIDT, or a calculator
+    from the estimators module
     `prop` needs to be set depending on the type of TE object.  See JIDT docs.
     `samples` is the number of surrogate samples produced for the confidence
     statistical test.
@@ -115,15 +156,18 @@ def slide_te_grp(calc, lrng, D1, D2, samples=100, verb=False, prop="DELAY" , k=1
     return R, P
 #}}}
 #{{{ apply TE - convenience wrapper to slide_te_grp + plot result
-def apply_TE_peaklag(D1, D2, ax, lagrng, s_lag, k=1, l=1, samples=500, alpha=0.05):
+def apply_TE_peaklag(D1, D2, ax, lagrng, s_lag, k=1, l=1, samples=500, alpha=0.05,
+                     backend=None):
     '''
     apply transfer entropy calculator (with MoG estimator) to data ensembles
     D1 and D2, for the time delays in lagrng, and plot on the matplotlib-like
     axes `ax`.  Fill circles for significant TE, empty circles for
     non-significant TE values.
+
+    backend 'jidt' or 'numpy' picks the calculator (default: JIDT if it
+    is available).
     '''
-    prep_jidt() # make sure toolbox ready
-    te_mog = prep_te_MoG() # initialise a TE calculator object
+    te_mog = prep_te_MoG(backend) # initialise a TE calculator object
 
     RG, PG, = slide_te_grp( # compute TE and significance for each l in lagrng
         te_mog, lagrng, D1, D2, samples=samples,
@@ -1,3 +1,5 @@
 from casu_reader import LogDataOwner
 from casu_reader import SingleLogDataOwner
-from process_logs import which_arena
+from process_logs import which_arena, load_project
+from casu_follow import LiveLogDataOwner
+from compact import TimedArray
@@ -0,0 +1,124 @@
+'''
+Align the clocks of several casus using their sync-flash logs, and resample
+their data onto one shared time grid.
+
+Every casu records the same sync flashes, each in its own clock.  For each
+casu, a line  t_ref = a + b * t_local  is fitted through the start events
+it shares with a reference casu; a is the clock offset and b - 1 the drift.
+With the clocks mapped onto the reference, all nodes' series are latched
+onto one grid (see process_logs.sample_signals), to give a dense
+(time x node x channel) array.
+
+The sync arrays are as read by LogDataOwner.read_data(sync=True): column 0
+is the local time of the flash start, column 1 its identifier.
+'''
+
+import numpy as np
+
+import process_logs as plg
+
+#{{{ clock estimation
+def _match_events(sync, sync_ref, match='id'):
+    '''
+    pair up the start events of one casu with those of the reference.
+    match='id' pairs events with the same identifier (column 1);
+    match='order' pairs the i-th event of each log.
+
+    returns two arrays of times (local, reference).
+    '''
+    s = np.atleast_2d(sync)
+    r = np.atleast_2d(sync_ref)
+    if match == 'id':
+        ids, i_s, i_r = np.intersect1d(s[:,1], r[:,1], return_indices=True)
+        return s[i_s, 0], r[i_r, 0]
+    elif match == 'order':
+        k = min(len(s), len(r))
+        return s[:k, 0], r[:k, 0]
+    raise ValueError("[E] unknown event matching '{}'".format(match))
+
+def estimate_clock(sync, sync_ref, match='id', drift=True):
+    '''
+    fit the map from one casu's clock onto the reference clock, from the
+    sync events in common.  With drift=False (or only one shared event),
+    only an offset is fitted.
+
+    returns (a, b), so that t_ref = a + b * t_local.
+    '''
+    t_loc, t_ref = _match_events(sync, sync_ref, match=match)
+    if len(t_loc) == 0:
+        print "[W] no sync events in common -- clock left unchanged"
+        return 0.0, 1.0
+
+    if drift and len(t_loc) > 1:
+        # centre the times, to keep the fit well conditioned
+        c = t_loc.mean()
+        b, a0 = np.polyfit(t_loc - c, t_ref, 1)
+        return a0 - b * c, b
+    return float(np.mean(t_ref - t_loc)), 1.0
+
+def estimate_clocks(syncs, ref=None, match='id', drift=True):
+    '''
+    clock maps for all nodes in the dict `syncs` (node -> sync array),
+    relative to node `ref` (default: the first node, in sorted order,
+    that has sync data).
+
+    returns dict node -> (a, b); nodes without sync data are omitted.
+    '''
+    have = sorted([n for n in syncs if syncs[n] is not None and np.size(syncs[n])])
+    if not len(have):
+        return {}
+    if ref is None:
+        ref = have[0]
+
+    clocks = {}
+    for node in have:
+        if node == ref:
+            clocks[node] = (0.0, 1.0)
+        else:
+            clocks[node] = estimate_clock(syncs[node], syncs[ref],
+                                          match=match, drift=drift)
+    return clocks
+
+def to_reference(raw, clock):
+    '''
+    copy of a series (time in column 0) with times mapped onto the
+    reference clock
+    '''
+    a, b = clock
+    out = np.array(raw, dtype=float)
+    out[:,0] = a + b * out[:,0]
+    return out
+#}}}
+
+#{{{ alignment of many nodes
+def align_series(series, clocks, dt=0.1, columns=None, method='latch',
+                 start_time=None, stop_time=None):
+    '''
+    map each node's series onto the reference clock and resample them all
+    onto one shared grid.
+
+    `series` is a dict node -> (samples, 1+channels) array, time first;
+    nodes without a clock in `clocks` are left unchanged (with a warning).
+    `columns` selects the data columns (default: all but time).
+
+    returns a (time, node, channel) array, the grid times (relative to the
+    start), the grid start time on the reference clock, and the nodes in
+    array order.
+    '''
+    nodelist = sorted([n for n in series if series[n] is not None])
+    mapped = []
+    for node in nodelist:
+        if node not in clocks:
+            print "[W] no clock estimate for {}, using its own clock".format(node)
+        mapped.append(to_reference(series[node], clocks.get(node, (0.0, 1.0))))
+
+    if start_time is None:
+        start_time = min([m[0,0] for m in mapped])
+    sampled, ts = plg.sample_signals(mapped, start_time=start_time,
+                                     stop_time=stop_time, dt=dt,
+                                     method=method)
+    if columns is None:
+        columns = range(1, sampled[0].shape[1])
+    stack = np.stack([s[:, columns] for s in sampled], axis=1)
+    return stack, ts, start_time, nodelist
+#}}}
@@ -0,0 +1,249 @@
+'''
+Load many replicate experiments as one collection.
+
+**ExperimentSet**
+Takes a list of LogDataOwner specs (sharing grp_base, shared_spec etc),
+and builds, reads, thresholds and computes hits for each, in a bounded
+pool of worker processes.  An experiment that fails (missing files, bad
+calibration, ...) is reported and left out, rather than stopping the rest.
+
+e.g.
+    specs = [{'base': 'expA', 'label': 'run{}'.format(i)} for i in xrange(50)]
+    es = ExperimentSet(specs, workers=8, grp_base=grp_base,
+                       shared_spec={'casus': casus})
+    es.load(thresh='calib')
+    st = es.stacked('ma_hits', dt=1.0)
+    st['layer-a']['data']     # (experiments, nodes, time), NaN-padded
+
+'''
+
+import os, sys, shutil, tempfile, multiprocessing, StringIO, traceback
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import process_logs as plg
+import casu_reader
+from casu_reader import LogDataOwner, _to_transport, _from_transport
+
+# per-node results that are one row per ir sample
+IR_ROW_FIELDS = ['hits', 'ma_hits']
+# per-node results computed from the series; small, so never memory-mapped
+DERIVED_FIELDS = IR_ROW_FIELDS + ['above_thr', 'thr', 'sync']
+
+def default_max_maps():
+    '''
+    how many arrays an ExperimentSet keeps memory-mapped (each holds a file
+    descriptor): a quarter of the soft RLIMIT_NOFILE, or 256 if unknown.
+    '''
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY:
+            return max(int(soft) // 4, 0)
+    return 256
+
+#{{{ one experiment - runs in pool workers
+def _process(owner, read_kw, thresh, thresh_kw, hits):
+    owner.read_data(**read_kw)
+    if thresh == 'guess':
+        owner.compute_thresh(**thresh_kw)
+    elif thresh == 'calib':
+        owner.load_calib_thresh(**thresh_kw)
+    elif thresh is not None:
+        raise ValueError("[E] unknown threshold method '{}'".format(thresh))
+    if hits and thresh is not None:
+        owner.compute_hits()
+
+def _load_experiment_job(job):
+    '''
+    build and process one experiment; console output is captured, and any
+    error is returned rather than raised.
+    '''
+    i, spec, owner_kw, read_kw, thresh, thresh_kw, hits, spill = job
+    buf = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, buf
+    owner, err = None, None
+    try:
+        owner = LogDataOwner(dict(spec), **owner_kw)
+        _process(owner, read_kw, thresh, thresh_kw, hits)
+    except Exception:
+        owner, err = None, traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+
+    if owner is not None and spill is not None:
+        for node, d in owner.nodes.items():
+            for k, v in d.items():
+                d[k] = _to_transport(v, os.path.join(
+                    spill, "{}-{}-{}.npy".format(i, node, k)))
+    return i, buf.getvalue(), owner, err
+#}}}
+
+#{{{ ExperimentSet
+class ExperimentSet(object):
+    '''
+    a list of experiments, each a LogDataOwner.  kwargs are passed to every
+    LogDataOwner (grp_base, shared_spec, cache, dtypes, ...).
+
+    With workers > 1, large arrays come back from the pool memory-mapped
+    (see casu_reader._from_transport); at most max_maps of them are kept
+    mapped (default: default_max_maps()), the rest are read into memory.
+    '''
+    def __init__(self, specs, workers=None, max_maps=None, **kwargs):
+        self.specs = list(specs)
+        self.workers = workers
+        self.max_maps = default_max_maps() if max_maps is None else max_maps
+        self.owner_kw = kwargs
+        self.owners = []      # in the order of specs, loaded ones only
+        self.labels = []
+        self.failed = {}      # label -> error text
+
+    @staticmethod
+    def label(spec):
+        return "{}/{}".format(spec.get('base'), spec.get('label'))
+
+    def load(self, read_kw=None, thresh='guess', thresh_kw=None, hits=True,
+             verb=False):
+        '''
+        build and read every experiment, then apply the same thresholding
+        (thresh='guess' for compute_thresh, 'calib' for load_calib_thresh,
+        or None) and compute_hits to all of them.  `read_kw` and
+        `thresh_kw` are passed on to read_data and the threshold method.
+
+        With verb=True the console output of each experiment is printed;
+        otherwise only progress lines.
+        '''
+        read_kw = dict(read_kw or {})
+        thresh_kw = dict(thresh_kw or {})
+        n = len(self.specs)
+        results = [None] * n
+        self.failed = {}
+        self._nmaps = 0
+
+        parallel = self.workers is not None and self.workers > 1 and n > 1
+        spill = tempfile.mkdtemp(prefix="cbtb-") if parallel else None
+        jobs = [(i, spec, self.owner_kw, read_kw, thresh, thresh_kw, hits, spill)
+                for i, spec in enumerate(self.specs)]
+        if parallel:
+            # pool workers can't start pools of their own
+            read_kw.pop('workers', None)
+            pool = multiprocessing.Pool(min(self.workers, n))
+            it = pool.imap_unordered(_load_experiment_job, jobs)
+        else:
+            it = (_load_experiment_job(job) for job in jobs)
+
+        try:
+            for done, (i, text, owner, err) in enumerate(it):
+                lbl = self.label(self.specs[i])
+                if verb:
+                    sys.stdout.write(text)
+                if err is None and spill is not None:
+                    try:
+                        self._receive(owner, spill)
+                    except Exception:
+                        owner, err = None, traceback.format_exc()
+                if err is not None:
+                    self.failed[lbl] = err
+                    print "[W] {}/{} experiment {} failed: {}".format(
+                        done + 1, n, lbl, err.strip().splitlines()[-1])
+                    continue
+                results[i] = owner
+                print "[I] {}/{} experiment {} loaded ({} nodes)".format(
+                    done + 1, n, lbl, len(owner.nodes))
+        finally:
+            if parallel:
+                pool.close()
+                pool.join()
+                # the spill files are read or mapped already, so can be unlinked
+                shutil.rmtree(spill, ignore_errors=True)
+
+        self.owners = [o for o in results if o is not None]
+        self.labels = [self.label(s) for s, o in zip(self.specs, results)
+                       if o is not None]
+        print "[I] loaded {} of {} experiments".format(len(self.owners), n)
+        if len(self.failed):
+            print "[W] failed: {}".format(", ".join(sorted(self.failed)))
+        return self
+
+    def _receive(self, owner, spill):
+        '''
+        replace the transported arrays of an owner sent back from the pool.
+        Derived fields, and everything once max_maps arrays are mapped, are
+        read into memory and their spill files removed straight away.
+        '''
+        for d in owner.nodes.values():
+            for k, v in d.items():
+                if k in DERIVED_FIELDS or self._nmaps >= self.max_maps:
+                    d[k] = _from_transport(v, mmap_min=None)
+                else:
+                    d[k] = _from_transport(v, casu_reader.MMAP_MIN_BYTES)
+                    if isinstance(d[k], np.memmap):
+                        self._nmaps += 1
+                        continue
+                if (isinstance(v, tuple) and v[0] == 'npy' and
+                        os.path.dirname(v[1]) == spill):
+                    os.remove(v[1])
+
+    def __len__(self):
+        return len(self.owners)
+
+    def __iter__(self):
+        return iter(self.owners)
+
+    def layers(self):
+        ''' sorted list of the layers that any loaded node is in '''
+        return sorted(set([d['layer'] for o in self.owners
+                           for d in o.nodes.values()]))
+
+    def stacked(self, field='ma_hits', dt=1.0, column=1, layers=None):
+        '''
+        arrays of `field` across experiments, one per layer.  Each node's
+        series is latched onto a grid of step dt (see plg.sample_signals)
+        that starts at the first sample of its experiment; hits and ma_hits
+        use the IR sample times, other fields their own times and the
+        given `column`.
+
+        returns dict layer -> {'data': (experiments, nodes, time) array,
+        'nodes': node names per experiment, 't': grid times,
+        'experiments': labels}.  Missing nodes and times are NaN.
+        '''
+        if layers is None:
+            layers = self.layers()
+        per_exp = []
+        for o in self.owners:
+            series = {}
+            for node, d in o.nodes.items():
+                if field in IR_ROW_FIELDS:
+                    if d.get(field) is None or d.get('ir') is None:
+                        continue
+                    series[node] = np.column_stack((d['ir'][:,0], d[field]))
+                elif d.get(field) is not None:
+                    series[node] = np.column_stack((d[field][:,0],
+                                                    d[field][:,column]))
+            nodelist = sorted(series)
+            sampled, ts = {}, np.zeros((0,))
+            if len(nodelist):
+                start = min([series[n][0,0] for n in nodelist])
+                _s, ts = plg.sample_signals(
+                    [series[n] for n in nodelist], start_time=start, dt=dt)
+                sampled = dict(zip(nodelist, [x[:,1] for x in _s]))
+            per_exp.append((o, sampled, ts))
+
+        grid = max([ts for (o, s, ts) in per_exp] or [np.zeros((0,))], key=len)
+        T = len(grid)
+        out = {}
+        for layer in layers:
+            names = [sorted([n for n in s if o.nodes[n]['layer'] == layer])
+                     for (o, s, ts) in per_exp]
+            N = max([len(nm) for nm in names] + [0])
+            data = np.full((len(per_exp), N, T), np.nan)
+            for e, ((o, s, ts), nm) in enumerate(zip(per_exp, names)):
+                for j, node in enumerate(nm):
+                    data[e, j, :len(s[node])] = s[node]
+            out[layer] = {'data': data, 'nodes': names,
+                          't': grid,
+                          'experiments': list(self.labels)}
+        return out
+#}}}
@@ -0,0 +1,293 @@
+'''
+Incremental reading of casu logs that are still being written.
+
+**LogFollower**
+Remembers the byte offset reached in one casu log, and on each poll only
+parses the complete lines appended since then.  A line without its newline
+is left for the next poll; a complete line that is not numeric where it
+should be is skipped with a warning.
+
+**LiveLogDataOwner**
+A SingleLogDataOwner whose data grows with each call to update(), so that
+compute_thresh/compute_hits etc can be re-run during a live experiment.
+A dtype policy (dtypes='compact') is applied to each appended block, so
+the series have the same dtypes as SingleLogDataOwner gives.
+
+e.g., for a whole arena, polled once per second:
+    owners = [LiveLogDataOwner(c, pth) for c in casus]
+    while running:
+        for o in owners:
+            o.update()
+            o.compute_hits()
+        time.sleep(1.0)
+
+'''
+
+import os
+import numpy as np
+
+import process_logs as plg
+import compact
+from casu_reader import SingleLogDataOwner
+
+# LogFollower record types -> data owner field names
+FIELD_NAMES = {'ir': 'ir', 'temp': 'temps', 'pelt': 'pelt',
+               'led': 'led', 'air': 'air'}
+
+#{{{ GrowableArray
+class GrowableArray(object):
+    '''
+    2d array with a fixed number of columns, that can be extended by rows
+    with amortised constant cost (capacity doubles when full).
+    '''
+    def __init__(self, ncols, capacity=1024, dtype=float):
+        self._buf = np.empty((capacity, ncols), dtype=dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._buf.dtype).reshape(
+            -1, self._buf.shape[1])
+        need = self._n + rows.shape[0]
+        if need > self._buf.shape[0]:
+            cap = max(need, 2 * self._buf.shape[0])
+            _buf = np.empty((cap, self._buf.shape[1]), dtype=self._buf.dtype)
+            _buf[:self._n] = self._buf[:self._n]
+            self._buf = _buf
+        self._buf[self._n:need] = rows
+        self._n = need
+
+    @property
+    def data(self):
+        ''' view on the filled rows (invalidated by the next extend) '''
+        return self._buf[:self._n]
+
+class GrowableTimedArray(object):
+    '''
+    GrowableArray for (samples, 1+channels) rows, held as a compact
+    TimedArray with values of dtype `vdtype` (see compact.compact_series).
+    For 'int', the values are held in the smallest integer dtype for the
+    range seen so far (re-cast when a block widens it), as compact_series
+    would pick for the whole series; if a block is not integer, the series
+    reverts to a plain float64 GrowableArray.
+    '''
+    def __init__(self, ncols, vdtype):
+        self.ncols = ncols
+        self.vdtype = vdtype
+        self._t = GrowableArray(1)
+        self._v = None
+        self._rows = None       # set once reverted to float64
+        self._lo, self._hi = np.inf, -np.inf
+
+    def __len__(self):
+        return len(self._rows) if self._rows is not None else len(self._t)
+
+    def _revert(self):
+        print "   [W] values are not small integers, kept as float64"
+        self._rows = GrowableArray(self.ncols)
+        if len(self._t):
+            self._rows.extend(np.column_stack((self._t.data, self._v.data)))
+        self._t = self._v = None
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=float).reshape(-1, self.ncols)
+        if self._rows is not None:
+            return self._rows.extend(rows)
+        v = rows[:, 1:]
+        vdtype = self.vdtype
+        if vdtype == 'int' and len(v):
+            if compact._int_dtype(v) is None:
+                self._revert()
+                return self._rows.extend(rows)
+            self._lo = min(self._lo, v.min())
+            self._hi = max(self._hi, v.max())
+            vdtype = compact._int_dtype(np.array([self._lo, self._hi]))
+            if vdtype is None:
+                self._revert()
+                return self._rows.extend(rows)
+        elif vdtype == 'int':
+            return
+        if self._v is None:
+            self._v = GrowableArray(self.ncols - 1, dtype=vdtype)
+        elif self._v.data.dtype != vdtype:
+            old = self._v.data
+            self._v = GrowableArray(self.ncols - 1, capacity=max(len(old), 1),
+                                    dtype=vdtype)
+            self._v.extend(old)
+        self._v.extend(v)
+        self._t.extend(rows[:, :1])
+
+    @property
+    def data(self):
+        ''' view on the filled rows (invalidated by the next extend) '''
+        if self._rows is not None:
+            return self._rows.data
+        if self._v is None:
+            return None
+        return compact.TimedArray(self._t.data[:, 0], self._v.data)
+#}}}
+
+#{{{ LogFollower
+def _parse_lines(lines, cols, fn):
+    '''
+    plg._parse_block on a block of lines; if it fails, the lines are parsed
+    one by one and any that can't be are skipped, with a warning.
+    '''
+    try:
+        return plg._parse_block(lines, cols)
+    except ValueError:
+        pass
+    rows = []
+    for line in lines:
+        try:
+            rows.append(plg._parse_block([line], cols))
+        except ValueError:
+            print "[W] {}: skipped malformed line '{}'".format(fn, line.strip())
+    if len(rows) == 0:
+        return np.empty((0, len(cols)))
+    return np.concatenate(rows)
+
+def _line_time(line):
+    ''' the timestamp field of a line, or None '''
+    fields = line.split(';')
+    try:
+        return float(fields[1]) if len(fields) > 1 else None
+    except ValueError:
+        return None
+
+class LogFollower(object):
+    '''
+    follow one casu log as it grows.  For each record type, the columns
+    parsed are the same as those used by SingleLogDataOwner.read_data.
+    '''
+    def __init__(self, cname, pth, ctype="phys", fields=None, dtypes=None):
+        self.cname = cname
+        self.pth = pth
+        rng = range(1,10)
+        if ctype == "sim":
+            rng = range(1,6)
+
+        self.cols = {
+            'ir':   range(1,8),
+            'temp': rng,
+            'pelt': [1,2,3],
+            'led':  range(1,5),
+            'air':  [1,2],
+        }
+        nf = dict(plg.LOG_NFIELDS)
+        nf['temp'] = rng[-1] + 1
+
+        self.rules = []
+        for (key, prefix, op, strip, drop) in plg.LOG_RECORDS:
+            if fields is None or key in fields:
+                self.rules.append((key, prefix, nf[key], op == '>='))
+
+        self.policy = compact.get_policy(dtypes)
+        self.series = dict((r[0], self._new_series(r[0])) for r in self.rules)
+        self.fn = None
+        self.offset = 0
+        self.t0 = None
+        self.tEnd = None
+
+    def reset(self):
+        ''' forget all data read so far (e.g. if the log was replaced) '''
+        for key in self.series:
+            self.series[key] = self._new_series(key)
+        self.offset = 0
+        self.t0 = None
+        self.tEnd = None
+
+    def _new_series(self, key):
+        vdtype = self.policy.get(FIELD_NAMES[key])
+        if vdtype is None:
+            return GrowableArray(len(self.cols[key]))
+        return GrowableTimedArray(len(self.cols[key]), vdtype)
+
+    def poll(self):
+        '''
+        read and parse complete lines appended since the last poll.
+
+        returns the number of new lines consumed.
+        '''
+        if self.fn is None:
+            # a live log is never compressed
+            self.fn = plg.get_dir_index(self.pth).casu_log(
+                self.cname, compressed=False)
+            if self.fn is None:
+                return 0
+        path = os.path.join(self.pth, self.fn)
+
+        size = os.path.getsize(path)
+        if size < self.offset:
+            # file was truncated or replaced; start over
+            print "[W] {} shrank; re-reading from start".format(self.fn)
+            self.reset()
+        if size == self.offset:
+            return 0
+
+        with open(path, 'r') as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+
+        # only consume up to the last complete line
+        end = chunk.rfind('\n')
+        if end < 0:
+            return 0
+        lines = chunk[:end].split('\n')
+
+        bufs = dict((r[0], []) for r in self.rules)
+        for line in lines:
+            for (key, prefix, n, at_least) in self.rules:
+                if line.startswith(prefix):
+                    nfields = line.count(';') + 1
+                    if (at_least and nfields >= n) or nfields == n:
+                        bufs[key].append(line)
+                    break
+
+        parsed = dict((key, _parse_lines(li, self.cols[key], self.fn))
+                      for key, li in bufs.items() if len(li))
+
+        # the whole block is parsed; only now is it consumed
+        self.offset += end + 1
+        for key, vals in parsed.items():
+            if len(vals):
+                self.series[key].extend(vals)
+        if self.t0 is None:
+            self.t0 = _line_time(lines[0])
+        t = _line_time(lines[-1])
+        if t is not None:
+            self.tEnd = t
+
+        return len(lines)
+#}}}
+
+#{{{ LiveLogDataOwner
+class LiveLogDataOwner(SingleLogDataOwner):
+    '''
+    SingleLogDataOwner for a casu log that is still being written.  Call
+    update() to take in newly appended data; self.data then holds views of
+    all data read so far.
+    '''
+    def __init__(self, cname, logpath, ctype="phys", fields=None, **kwargs):
+        super(LiveLogDataOwner, self).__init__(cname, logpath, ctype, **kwargs)
+        self.follower = LogFollower(cname, logpath, ctype=ctype, fields=fields,
+                                    dtypes=self.dtypes)
+        self._t0, self._tEnd = None, None
+
+    def read_data(self, *args, **kwargs):
+        ''' for a live log, reading the data is just an update '''
+        return self.update()
+
+    def update(self):
+        '''
+        parse lines appended since the last update, and refresh self.data.
+        returns the number of new lines.
+        '''
+        n = self.follower.poll()
+        for key, ga in self.follower.series.items():
+            self.data[FIELD_NAMES[key]] = ga.data if len(ga) else None
+        self._t0, self._tEnd = self.follower.t0, self.follower.tEnd
+        return n
+#}}}
@@ -18,12 +18,197 @@ TODO:
     validate whether SingleLogDataOwner needs nodes= kw.
 '''
 
-import os
+import os, sys, shutil, tempfile, multiprocessing, StringIO
 import process_logs as plg
+import log_cache
+import align as aln
+import compact
 import fnmatch, yaml
 
 import numpy as np
 
+# arrays handed back from pool workers at least this large are memory-mapped
+# rather than read into memory (see _from_transport)
+MMAP_MIN_BYTES = 64 * 2**20
+
+#{{{ load_series - single pass over one casu log
+def load_series(cname, ddir, ctype="phys", ir=True, temp=True, pelt=True,
+                all_led=False, air=False, cache=False, cache_dir=None):
+    '''
+    parse all of the requested series for one casu from its log, with one
+    pass over the file (see process_logs.read_all_series).
+
+    If `cache` is True, the parsed arrays are kept in a sidecar cache (see
+    log_cache) and loaded from there, memory-mapped, while the log is
+    unchanged.
+
+    returns a dict with keys ir, temps, pelt, led, air (None if not
+    requested) and t0, tEnd.
+    '''
+    rng = range(1,10)
+    if ctype == "sim":
+        rng = range(1,6)
+
+    requested = [(k, key) for (k, key, req) in [
+        ('ir', 'ir', ir), ('temp', 'temps', temp), ('pelt', 'pelt', pelt),
+        ('led', 'led', all_led), ('air', 'air', air)] if req]
+
+    data = {'ir': None, 'temps': None, 'pelt': None, 'led': None, 'air': None}
+    fn = plg.identify_log(cname, ddir)
+    if fn is None:
+        raise IOError("[E] no casu log found for {} in {}".format(cname, ddir))
+    logfile = os.path.join(ddir, fn)
+
+    if cache:
+        keys = [key for (k, key) in requested] + ['t0', 'tEnd']
+        cached = log_cache.load(logfile, keys, cache_dir=cache_dir, tag=ctype)
+        if cached is not None:
+            print "   [I] loaded {} for {} from cache".format(
+                ", ".join(keys[:-2]), cname)
+            data.update(cached)
+            return data
+
+    fields = [k for (k, key) in requested]
+    usecols = {'ir': range(1,8), 'temp': rng, 'pelt': (1,2,3),
+               'led': range(1,5), 'air': (1,2)}
+    series = plg.read_all_series(cname, ddir, fields=fields,
+                                 minlens={'temp': rng[-1] + 1},
+                                 usecols=usecols)
+
+    if temp is True:
+        print "   [I] reading temp data {}, casu type={} ==> nfields={}".format(
+                cname, ctype, rng[-1])
+    if pelt is True:
+        print "   [I] read peltier data {} ({} li)".format(
+                cname, len(series['pelt']))
+
+    for (k, key) in requested:
+        data[key] = series[k]
+    data['t0'] = series['t0']
+    data['tEnd'] = series['tEnd']
+
+    if cache:
+        log_cache.store(logfile, data, cache_dir=cache_dir, tag=ctype)
+    return data
+
+def load_sync(cname, ddir, cache=False, cache_dir=None):
+    '''
+    read the syncflash start events for one casu (see
+    process_logs.read_syncflash), optionally through the sidecar cache.
+    '''
+    if cache:
+        fn = plg.identify_synclog(cname, ddir)
+        if fn is not None:
+            syncfile = os.path.join(ddir, fn)
+            cached = log_cache.load(syncfile, ['sync'], cache_dir=cache_dir,
+                                    tag='sync')
+            if cached is not None:
+                return cached['sync']
+
+    _sync_lines = plg.read_syncflash(cname, ddir)
+    sync = np.loadtxt(_sync_lines, usecols=(0,1,), delimiter=';')
+    if cache and fn is not None:
+        log_cache.store(syncfile, {'sync': sync}, cache_dir=cache_dir,
+                        tag='sync')
+    return sync
+#}}}
+
+#{{{ parallel loading of nodes - runs in pool workers
+def _to_transport(v, fn):
+    '''
+    arrays are handed back to the parent as .npy files rather than pickled:
+    either the cache file they are already mapped from, or a spill file.
+    '''
+    if not isinstance(v, np.ndarray) or v.size == 0:
+        return v
+    if isinstance(v, np.memmap) and v.filename is not None and \
+            v.filename.endswith('.npy'):
+        return ('npy', v.filename)
+    np.save(fn, v)
+    return ('npy', fn)
+
+def _from_transport(v, mmap_min=MMAP_MIN_BYTES):
+    '''
+    the array sent by _to_transport.  Files of at least mmap_min bytes are
+    memory-mapped (copy-on-write), which saves a copy but keeps one file
+    descriptor open for as long as the array is alive; smaller ones (or
+    all, with mmap_min=None) are read into memory and hold no descriptor.
+    '''
+    if isinstance(v, tuple) and len(v) == 2 and v[0] == 'npy':
+        if mmap_min is not None and os.path.getsize(v[1]) >= mmap_min:
+            return np.load(v[1], mmap_mode='c')
+        return np.load(v[1])
+    return v
+
+def _read_node_job(job):
+    '''
+    load sync and log series for one node; console output is captured so
+    that the parent can print it in node order.
+    '''
+    node, ddir, ctype, flags, cache, cache_dir, spill = job
+    buf = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, buf
+    try:
+        series = {}
+        if flags['sync'] is True:
+            series['sync'] = load_sync(node, ddir, cache=cache,
+                                       cache_dir=cache_dir)
+        _s = load_series(node, ddir, ctype=ctype, ir=flags['ir'],
+                         temp=flags['temp'], pelt=flags['pelt'],
+                         all_led=flags['all_led'], cache=cache,
+                         cache_dir=cache_dir)
+        for k in ['ir', 'temps', 'pelt', 'led', 't0', 'tEnd']:
+            series[k] = _s[k]
+    finally:
+        sys.stdout = stdout
+
+    out = {}
+    for k, v in series.items():
+        out[k] = _to_transport(v, os.path.join(spill, "{}-{}.npy".format(node, k)))
+    return buf.getvalue(), out
+#}}}
+
+#{{{ LazyFieldDict
+class LazyFieldDict(dict):
+    '''
+    dict of data series in which some entries are still pending: they read
+    as None until first accessed, at which point `loader(keys)` is called
+    to parse them (it must set them, which clears the pending state).
+    '''
+    def __init__(self, loader, pending):
+        dict.__init__(self)
+        self._loader = loader
+        self._pending = set()
+        for k in pending:
+            dict.__setitem__(self, k, None)
+        self._pending.update(pending)
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self.load([key])
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self._pending.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def pending(self):
+        return sorted(self._pending)
+
+    def load(self, keys):
+        ''' parse any of `keys` that are still pending, in one go '''
+        keys = [k for k in keys if k in self._pending]
+        if len(keys):
+            self._loader(keys)
+            # the loader didn't give these, so don't try again
+            self._pending.difference_update(keys)
+#}}}
+
 #{{{ SingleLogDataOwner
 class SingleLogDataOwner(object):
     '''
@@ -33,6 +218,7 @@ class SingleLogDataOwner(object):
     casu name, and only loads data for that one casu.
     '''
     dirs = ['F', 'FR', 'BR', 'B', 'BL', 'FL', ]
+    lazy_fields = ['ir', 'temps', 'pelt', 'led', 'air']
 
     def __init__(self, cname, logpath, ctype="phys", **kwargs):
         '''
@@ -44,6 +230,14 @@ class SingleLogDataOwner(object):
         casu name in the form "casu-xxx" (but could be anything esp if in sim)
         ctype [sim or phys] data produced are not identical
 
+        with lazy=True, nothing is read until a field is used, e.g.
+        owner.data['temps'] or owner.temps; each field is parsed (or
+        loaded from the cache) on first access.  read_data can still be
+        used to parse several fields in one pass up front.
+
+        with dtypes='compact', series are held as compact.TimedArray's
+        (float64 times, int16 IR, float32 temperatures etc) rather than
+        float64 arrays; a dict of field -> dtype can also be given.
 
         '''
 
@@ -52,6 +246,9 @@ class SingleLogDataOwner(object):
         self.ctype = ctype
         self.nchannels   = 6
         self.movavg_len  = kwargs.get('movavg_len', 61)
+        self.cache       = kwargs.get('cache', True)
+        self.cache_dir   = kwargs.get('cache_dir', None)
+        self.dtypes      = compact.get_policy(kwargs.get('dtypes', None))
         self._settings = dict(kwargs)
 
         if not os.path.isdir(self.pth):
@@ -60,27 +257,73 @@ class SingleLogDataOwner(object):
             print "[I] reading from {}".format(self.pth)
 
 
-        self.data = {}
-        self.data['ir'] = None
-        self.data['temps'] = None
-        self.data['pelt'] = None
+        self.lazy = kwargs.get('lazy', False)
+        if self.lazy:
+            self.data = LazyFieldDict(self._load_fields, self.lazy_fields)
+        else:
+            self.data = {}
+            for k in self.lazy_fields:
+                self.data[k] = None
         self.data['sync'] = None
-        self.data['led'] = None
-        self.data['air'] = None
         self.data['t_offset_temps'] = self._settings.get('t_offset_temps', 0)
+        self._t0, self._tEnd = None, None
 
         # makes an assumption that name is somethig like "casu-005"
         # and produces c3
         self.shortname = "c{}".format(self.cname.split('-')[-1].lstrip('0'))
 
+    def __getattr__(self, name):
+        # only called if normal lookup fails: give owner.ir etc.
+        data = self.__dict__.get('data')
+        if data is not None and name in self.lazy_fields:
+            return data[name]
+        raise AttributeError(name)
+
+    def _load_fields(self, keys):
+        '''
+        parse the fields in `keys` from the log, in one pass (used by the
+        lazy data dict)
+        '''
+        series = load_series(self.cname, self.pth, ctype=self.ctype,
+                             ir='ir' in keys, temp='temps' in keys,
+                             pelt='pelt' in keys, all_led='led' in keys,
+                             air='air' in keys,
+                             cache=self.cache, cache_dir=self.cache_dir)
+        for k in keys:
+            self.data[k] = series[k]
+        compact.apply_policy(self.data, self.dtypes, keys)
+        self._t0, self._tEnd = series['t0'], series['tEnd']
+
     def read_data(self, ir=True, temp=True, pelt=True, sync=False,
-                  all_led=False, air=False, nodes='all'):
+                  all_led=False, air=False, nodes='all', single_pass=True):
+        '''
+        parse the requested fields from the casu log.  By default, all fields
+        are extracted in one pass over the file; set single_pass=False to
+        use the individual readers (one pass per field).
+        '''
 
         s1 = "# ===========  reading data for node '{}' ========== #".format(
             self.cname,)
         print s1
         print "# ===  file pth: '{}' ".format(self.pth)
 
+        if sync is True:
+            raise NotImplementedError("[E] without paths, probably used other framework. Not looking for syncflash file")
+            #_sync_lines = plg.read_syncflash(self.cname, self.pth)
+            #self.data['sync'] = np.loadtxt(
+            #        _sync_lines, usecols=(0,1,), delimiter=';')
+
+        if single_pass:
+            keys = [k for (k, req) in [('ir', ir), ('temps', temp),
+                                       ('pelt', pelt), ('led', all_led),
+                                       ('air', air)] if req]
+            if self.lazy:
+                # only those not yet parsed
+                self.data.load(keys)
+            else:
+                self._load_fields(keys)
+            print "# {} #\n".format("=" * (len(s1) - 4))
+            return
 
         if temp is True:
             rng = range(1,10)
@@ -107,13 +350,6 @@ class SingleLogDataOwner(object):
             self.data['ir'] = np.loadtxt(
                     ir_lines, usecols=xrange(1,8), delimiter=';')
 
-        if sync is True:
-            raise NotImplementedError("[E] without paths, probably used other framework. Not looking for syncflash file")
-            #_sync_lines = plg.read_syncflash(self.cname, self.pth)
-            #self.data['sync'] = np.loadtxt(
-            #        _sync_lines, usecols=(0,1,), delimiter=';')
-
-
         if all_led is True:
             _led_lines = plg.read_led_data(self.cname, self.pth)
             self.data['led'] = np.loadtxt(
@@ -125,6 +361,8 @@ class SingleLogDataOwner(object):
                 _air_lines, usecols=(1,2), delimiter=';')
 
 
+        compact.apply_policy(self.data, self.dtypes)
+
         # get the extreme time values from log file
         self._t0, self._tEnd = plg.read_tstart_tstop(self.cname, self.pth)
 
@@ -184,6 +422,9 @@ class LogDataOwner(object):
         the data is expected to be in
         grp_base/base/label/
         if grp_base is not set, the base should be relative or canonical.
+
+        dtypes='compact' holds series as compact.TimedArray's (see
+        SingleLogDataOwner).
         '''
 
         self.spec = spec
@@ -192,6 +433,9 @@ class LogDataOwner(object):
         self.grp_base    = kwargs.get('grp_base', "")
         self.shared_spec = kwargs.get('shared_spec', {})
         self.dep_dir     = kwargs.get('dep_dir', None)
+        self.cache       = kwargs.get('cache', True)
+        self.cache_dir   = kwargs.get('cache_dir', None)
+        self.dtypes      = compact.get_policy(kwargs.get('dtypes', None))
 
         self.pth = os.path.join(self.grp_base, self.spec['base'], self.spec['label'])
         if not os.path.isdir(self.pth):
@@ -222,8 +466,9 @@ class LogDataOwner(object):
         _scasus = self.shared_spec.get('casus', [])
         casu_list = self.spec.get('casus', _scasus)
 
+        self.project = plg.load_project(self.proj_file)
         for cname in casu_list:
-            layer = plg.which_arena(self.proj_file, cname)
+            layer = self.project.which_arena(cname)
             self.spec['layers'].append(layer)
             if layer is not None:
                 data_dir = os.path.join(self.pth, self.data_root, layer, cname)
@@ -233,25 +478,52 @@ class LogDataOwner(object):
                         'ctype': ctype,
                         }
 
-    def read_data(self, ir=True, temp=True, pelt=True, sync=True, all_led=False, nodes='all'):
+    def read_data(self, ir=True, temp=True, pelt=True, sync=True, all_led=False,
+                  nodes='all', single_pass=True, workers=None):
+        '''
+        parse the requested fields for each node in `nodes`.  By default, all
+        fields of a casu log are extracted in one pass over the file; set
+        single_pass=False to use the individual readers.
+
+        With workers=N (N > 1), nodes are parsed in a pool of N processes.
+        Arrays of MMAP_MIN_BYTES or more are then memory-mapped, each one
+        holding an open file descriptor until it is freed.
+        '''
         if nodes == 'all':
             nodelist = self.nodes.keys()
         else:
             nodelist = nodes
 
+        if workers is not None and workers > 1 and single_pass:
+            flags = dict(ir=ir, temp=temp, pelt=pelt, sync=sync, all_led=all_led)
+            self._read_data_parallel(nodelist, workers, flags)
+            return
+
         for node in nodelist:
             s1 = "# ===========  reading data for node '{}' ========== #".format(node)
             print s1
-            self.nodes[node]['ir'] = None
-            self.nodes[node]['temps'] = None
-            self.nodes[node]['pelt'] = None
-            self.nodes[node]['sync'] = None
-            self.nodes[node]['led'] = None
-            self.nodes[node]['t_offset_temps'] = self.spec.get('t_offset_temps', 0)
+            self._reset_node_data(node)
 
 
             ddir = self.nodes[node].get('data_dir')
 
+            if sync is True:
+                self.nodes[node]['sync'] = load_sync(
+                    node, ddir, cache=self.cache and single_pass,
+                    cache_dir=self.cache_dir)
+
+            if single_pass:
+                series = load_series(node, ddir,
+                                     ctype=self.nodes[node].get('ctype'),
+                                     ir=ir, temp=temp, pelt=pelt,
+                                     all_led=all_led,
+                                     cache=self.cache, cache_dir=self.cache_dir)
+                for k in ['ir', 'temps', 'pelt', 'led', 't0', 'tEnd']:
+                    self.nodes[node][k] = series[k]
+                compact.apply_policy(self.nodes[node], self.dtypes)
+                print "# {} #\n".format("=" * (len(s1) - 4))
+                continue
+
             if temp is True:
                 rng = range(1,10)
                 if self.nodes[node].get('ctype') == "sim":
@@ -277,23 +549,57 @@ class LogDataOwner(object):
                 self.nodes[node]['ir'] = np.loadtxt(
                         ir_lines, usecols=xrange(1,8), delimiter=';')
 
-            if sync is True:
-                _sync_lines = plg.read_syncflash(node, ddir)
-                self.nodes[node]['sync'] = np.loadtxt(
-                        _sync_lines, usecols=(0,1,), delimiter=';')
-
-
             if all_led is True:
                 _led_lines = plg.read_led_data(node, ddir)
                 self.nodes[node]['led'] = np.loadtxt(
                     _led_lines, usecols=xrange(1,5), delimiter=';')
 
+            compact.apply_policy(self.nodes[node], self.dtypes)
             print "# {} #\n".format("=" * (len(s1) - 4))
 
 
 
 
 
+    def _reset_node_data(self, node):
+        self.nodes[node]['ir'] = None
+        self.nodes[node]['temps'] = None
+        self.nodes[node]['pelt'] = None
+        self.nodes[node]['sync'] = None
+        self.nodes[node]['led'] = None
+        self.nodes[node]['t_offset_temps'] = self.spec.get('t_offset_temps', 0)
+
+    def _read_data_parallel(self, nodelist, workers, flags):
+        '''
+        parse nodes in a process pool.  Arrays come back as .npy files (the
+        cache entries, or a temporary spill directory) rather than being
+        pickled; see _from_transport for which are read in and which are
+        memory-mapped.  The console output of each node is printed in node
+        order.
+        '''
+        spill = tempfile.mkdtemp(prefix="cbtb-")
+        jobs = [(node, self.nodes[node].get('data_dir'),
+                 self.nodes[node].get('ctype'), flags, self.cache,
+                 self.cache_dir, spill) for node in nodelist]
+
+        pool = multiprocessing.Pool(min(workers, max(len(jobs), 1)))
+        try:
+            for node, (text, series) in zip(nodelist,
+                                             pool.imap(_read_node_job, jobs)):
+                s1 = "# ===========  reading data for node '{}' ========== #".format(node)
+                print s1
+                sys.stdout.write(text)
+                self._reset_node_data(node)
+                for k, v in series.items():
+                    self.nodes[node][k] = _from_transport(v)
+                compact.apply_policy(self.nodes[node], self.dtypes)
+                print "# {} #\n".format("=" * (len(s1) - 4))
+        finally:
+            pool.close()
+            pool.join()
+            # the spill files are read or mapped already, so can be unlinked
+            shutil.rmtree(spill, ignore_errors=True)
+
     def load_calib_thresh(self, calib_file="temp_calib_log"):
         '''
         if the file exists, attempt to read the values for each sensor
@@ -335,7 +641,24 @@ class LogDataOwner(object):
                     print "[W] did not read calibration data for {}".format(n)
 
 
-    def compute_thresh(self, pre_skip=10, steps=50, fixed_offset=None):
+    def compute_thresh(self, pre_skip=10, steps=50, fixed_offset=None,
+                       batched=False):
+        '''
+        guess IR thresholds from the start of each node's data.  With
+        batched=True, all nodes and channels are done in one array op (same
+        values).
+        '''
+        if batched:
+            nodelist = [n for n in self.nodes.keys()
+                        if self.nodes[n]['ir'] is not None]
+            if not len(nodelist):
+                return
+            thr = plg.guess_ir_thresh_batch(
+                [self.nodes[n]['ir'][:, 1:1+self.nchannels] for n in nodelist],
+                gain=1.1, pre_skip=pre_skip, steps=steps, offset=fixed_offset)
+            for i, node in enumerate(nodelist):
+                self.nodes[node]['thr'] = thr[i]
+            return
 
         for node in self.nodes.keys():
             if self.nodes[node]['ir'] is not None:
@@ -370,11 +693,75 @@ class LogDataOwner(object):
                 above_thr = ir_raw[:, 0:self.nchannels] > thr[0:self.nchannels]
                 hits = (above_thr).sum(axis=1)
                 #hits = (ir_raw[:, 0:self.nchannels] > thr[0:self.nchannels]).sum(axis=1)
-                ma_hits = plg.movingaverage(hits, self.movavg_len) / float(self.nchannels)
+                ma_hits = plg.movingaverage_nd(hits, self.movavg_len) / float(self.nchannels)
                 self.nodes[node]['above_thr'] = above_thr
                 self.nodes[node]['hits']      = hits
                 self.nodes[node]['ma_hits']   = ma_hits
 
+    def stack_ir(self, dt=0.1, nodes='all'):
+        '''
+        resample the IR data of all nodes onto one shared time grid (see
+        plg.sample_signals), as a (nodes, samples, channels) array.
+
+        returns the stack, the grid timesteps, and the list of nodes in
+        stack order.
+        '''
+        if nodes == 'all':
+            nodes = self.nodes.keys()
+        nodelist = sorted([n for n in nodes if self.nodes[n].get('ir') is not None])
+        sampled, ts = plg.sample_signals(
+            [self.nodes[n]['ir'] for n in nodelist], dt=dt)
+        stack = np.stack([smp[:, 1:1+self.nchannels] for smp in sampled])
+        return stack, ts, nodelist
+
+    def compute_hits_batch(self, dt=0.1, packed=False, nodes='all'):
+        '''
+        batched version of compute_hits: stack the nodes' IR data onto a
+        shared time grid of step dt, and compute above-threshold masks, hit
+        counts and moving averages for all nodes in a few array ops.
+        (compute_thresh must have been run, or calibration loaded.)
+
+        Results are in self.stack, with keys nodes, t, ir, thr, above_thr,
+        hits and ma_hits; arrays are indexed (node, sample[, channel]).
+        With packed=True, above_thr is bit-packed (see plg.unpack_above).
+        '''
+        stack, ts, nodelist = self.stack_ir(dt=dt, nodes=nodes)
+        thr = np.stack([self.nodes[n]['thr'] for n in nodelist])
+        above_thr, hits, ma_hits = plg.ir_hits_batch(
+            stack, thr, movavg_len=self.movavg_len, packed=packed)
+
+        self.stack = {
+            'nodes': nodelist, 't': ts, 'ir': stack, 'thr': thr,
+            'above_thr': above_thr, 'hits': hits, 'ma_hits': ma_hits,
+            'packed': packed,
+        }
+        return self.stack
+
+    def align(self, field='ir', dt=0.1, ref=None, columns=None, drift=True,
+              match='id', method='latch'):
+        '''
+        estimate each node's clock offset and drift from the sync-flash
+        start events (read_data with sync=True), and resample `field` of
+        every node onto one shared grid on the clock of node `ref`.
+
+        Results are in self.aligned, with keys data (a time x node x
+        channel array), t (grid times from start), t0 (grid start, on the
+        reference clock), nodes (in array order) and clocks (node -> (a, b)
+        with t_ref = a + b * t_local).
+        '''
+        clocks = aln.estimate_clocks(
+            dict((n, self.nodes[n].get('sync')) for n in self.nodes),
+            ref=ref, match=match, drift=drift)
+        series = dict((n, self.nodes[n].get(field)) for n in self.nodes)
+        data, ts, t0, nodelist = aln.align_series(
+            series, clocks, dt=dt, columns=columns, method=method)
+
+        self.aligned = {
+            'field': field, 'data': data, 't': ts, 't0': t0,
+            'nodes': nodelist, 'clocks': clocks,
+        }
+        return self.aligned
+
     def remove_node(self, key):
         '''
         if, for whatever reason, the data is judged not to be suitable to include
@@ -0,0 +1,304 @@
+'''
+Out-of-core processing of long casu logs, in fixed-size chunks.
+
+iter_log_chunks streams one record type of a casu log as parsed blocks of
+rows, so a whole experiment never has to be held at once.  The classes
+below are versions of the process_logs tools that carry their state across
+chunk boundaries, so that stitching their outputs together gives the same
+result as the whole-series function:
+
+  ChunkedThreshold      guess_ir_thresh / guess_ir_with_offset
+  ChunkedRollingMean    rolling.rolling_mean (edges 'zero' or 'shrink'),
+                        i.e. movingaverage
+  ChunkedSampler        sample_signal (latch), for time-ordered data
+
+and chunked_hits chains them into a bounded-memory pass that gives IR hits
+and their moving average, e.g.
+    for blk in chunked_hits('casu-001', pth):
+        summarise(blk['t'], blk['ma_hits'])
+
+'''
+
+import os
+import numpy as np
+
+import process_logs as plg
+import rolling
+
+#{{{ iter_log_chunks
+def iter_log_chunks(cname, pth, field='ir', chunksize=100000, ctype="phys",
+                    usecols=None, droptail=True):
+    '''
+    yield the records of type `field` (ir, temp, pelt, led, air) in a casu
+    log as float arrays of up to `chunksize` rows, parsing the columns used
+    by the data owners (or `usecols`).  The same field-count and droptail
+    rules as read_all_series apply.
+    '''
+    rng = range(1,10)
+    if ctype == "sim":
+        rng = range(1,6)
+    cols = {'ir': range(1,8), 'temp': rng, 'pelt': (1,2,3),
+            'led': range(1,5), 'air': (1,2)}
+    nf = dict(plg.LOG_NFIELDS)
+    nf['temp'] = rng[-1] + 1
+    if usecols is None:
+        usecols = cols[field]
+
+    rule = [r for r in plg.LOG_RECORDS if r[0] == field]
+    if not len(rule):
+        raise ValueError("[E] unknown record type '{}'".format(field))
+    (key, prefix, op, strip, drop) = rule[0]
+    n, at_least = nf[field], op == '>='
+
+    fn = plg.identify_log(cname, pth)
+    if fn is None:
+        raise IOError("[E] no casu log found for {} in {}".format(cname, pth))
+
+    buf = []
+    with plg.open_log(os.path.join(pth, fn)) as f:
+        for line in f:
+            if line.startswith(prefix):
+                nfields = line.count(';') + 1
+                if (at_least and nfields >= n) or nfields == n:
+                    buf.append(line)
+                    # hold one line back: the last one may be dropped
+                    if len(buf) > chunksize:
+                        yield plg._parse_block(buf[:-1], usecols)
+                        del buf[:-1]
+
+    if droptail and drop and len(buf):
+        buf.pop()
+    if len(buf):
+        yield plg._parse_block(buf, usecols)
+#}}}
+
+#{{{ stateful versions of the analysis tools
+class ChunkedThreshold(object):
+    '''
+    IR thresholds from the calibration window [pre_skip:pre_skip+steps],
+    collected over however many chunks it spans.  thr is None until the
+    window is complete (or finish() is called).
+    '''
+    def __init__(self, nchannels=6, gain=1.1, steps=50, pre_skip=5,
+                 offset=None):
+        self.nchannels = nchannels
+        self.gain, self.steps, self.pre_skip = gain, steps, pre_skip
+        self.offset = offset
+        self._rows = []
+        self._seen = 0
+        self.thr = None
+
+    def update(self, ir_raw):
+        ''' ir_raw: (samples, channels) chunk; returns thr (or None) '''
+        if self.thr is not None:
+            return self.thr
+        a, b = self.pre_skip - self._seen, self.pre_skip + self.steps - self._seen
+        self._rows.append(ir_raw[max(a, 0):max(b, 0)])
+        self._seen += ir_raw.shape[0]
+        if self._seen >= self.pre_skip + self.steps:
+            self.finish()
+        return self.thr
+
+    def finish(self):
+        if self.thr is None:
+            win = np.concatenate(self._rows)
+            self.thr = plg.guess_ir_thresh_batch(
+                [win], gain=self.gain, steps=self.steps, pre_skip=0,
+                offset=self.offset)[0]
+            self._rows = []
+        return self.thr
+
+class ChunkedRollingMean(object):
+    '''
+    rolling_mean(edges='zero' or 'shrink') along axis 0, fed in chunks.
+    Outputs lag the inputs by (w-1)//2 samples (the forward half of the
+    window); finish() returns the last ones.  Concatenating all outputs
+    gives the whole-series result.
+    '''
+    def __init__(self, window_size, edges='zero'):
+        if edges not in ['zero', 'shrink']:
+            raise ValueError("[E] chunked rolling mean supports 'zero' and "
+                             "'shrink' edges, not '{}'".format(edges))
+        self.w = int(window_size)
+        self.edges = edges
+        self._buf = None   # the last w-1 samples of the (padded) stream
+        self._cnt = None   # 1 for real samples, 0 for padding
+
+    def _start(self, chunk):
+        # w//2 samples of padding before the first real one
+        shape = (self.w // 2,) + chunk.shape[1:]
+        self._buf = np.zeros(shape)
+        self._cnt = np.zeros((self.w // 2,))
+
+    def _emit(self, vals, cnt):
+        ext = np.concatenate([self._buf, vals])
+        ext_c = np.concatenate([self._cnt, cnt])
+        keep = self.w - 1
+        self._buf = ext[max(len(ext) - keep, 0):] if keep else ext[:0]
+        self._cnt = ext_c[max(len(ext_c) - keep, 0):] if keep else ext_c[:0]
+        if len(ext) < self.w:
+            return np.zeros((0,) + ext.shape[1:])
+
+        s = rolling.rolling_sum(ext, self.w, axis=0, edges='valid')
+        if self.edges == 'zero':
+            return s / float(self.w)
+        c = rolling.rolling_sum(ext_c, self.w, edges='valid')
+        c = c.reshape(c.shape + (1,) * (ext.ndim - 1))
+        return s / np.maximum(c, 1)
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=float)
+        if self._buf is None:
+            self._start(chunk)
+        return self._emit(chunk, np.ones((len(chunk),)))
+
+    def finish(self):
+        if self._buf is None:
+            return np.zeros((0,))
+        pad = (self.w - 1) // 2
+        return self._emit(np.zeros((pad,) + self._buf.shape[1:]),
+                          np.zeros((pad,)))
+
+class ChunkedSampler(object):
+    '''
+    sample_signal (zero-order latch) fed with a series in chunks.  Each
+    update returns the grid samples (and timesteps) that are already
+    determined; finish() returns the rest.  For time-ordered data, the
+    concatenated output is identical to sample_signal on the whole series.
+
+    Only the rows that pending grid samples may still latch onto (about dt
+    worth) are kept between chunks.
+    '''
+    def __init__(self, dt=0.1, start_time=None, t_offset=0.0):
+        self.dt = dt
+        self.start_time = start_time
+        self.t_offset = t_offset
+        self.first_time = None
+        self._k = 0             # grid samples emitted so far
+        self._t = -dt           # internal clock, before sample k
+        self._rows = None       # rows carried over, and their running
+        self._el = None         # max of elapsed time
+        self._elapsed_max = -np.inf
+
+    def _grid(self, upto):
+        # latch and report times for samples k..upto-1, continuing the
+        # running sum of the internal clock (as _sample_times does)
+        steps = np.empty((upto - self._k + 1,))
+        steps[0] = self._t
+        steps[1:] = self.dt
+        t = np.cumsum(steps)
+        return t[:-1], t[1:]
+
+    def _take(self, upto):
+        t_latch, t_report = self._grid(upto)
+        idx = np.minimum(np.searchsorted(self._el, t_latch, side='left'),
+                         len(self._el) - 1)
+        if len(t_report):
+            self._t = t_report[-1]
+        self._k = upto
+        sampled = np.asarray(self._rows[idx], dtype=float)
+        return sampled, t_report + self.t_offset
+
+    def update(self, raw):
+        raw = np.asarray(raw)
+        if not len(raw):
+            return np.zeros((0, raw.shape[-1])), np.zeros((0,))
+        if self.first_time is None:
+            self.first_time = raw[0,0] if self.start_time is None else self.start_time
+            self._rows = raw[:0]
+            self._el = np.zeros((0,))
+
+        el = np.maximum.accumulate(
+            np.maximum(raw[:,0] - self.first_time, self._elapsed_max))
+        self._elapsed_max = el[-1]
+        self._rows = np.concatenate([self._rows, raw])
+        self._el = np.concatenate([self._el, el])
+
+        # grid samples that will exist whatever comes next (times are
+        # ordered), and whose latch row has been seen
+        n_now = int(np.ceil(float(raw[-1,0] - self.first_time) / self.dt))
+        t_lat, _ = self._grid(max(n_now, self._k))
+        upto = self._k + np.searchsorted(t_lat, self._elapsed_max, side='left')
+        upto = min(upto, n_now)
+        if upto > self._k:
+            out = self._take(upto)
+        else:
+            out = np.zeros((0, raw.shape[1])), np.zeros((0,))
+
+        # keep the rows from the first one the next grid sample may latch
+        # onto (and always the last row)
+        t_next = self._grid(self._k + 1)[0][0]
+        keep = min(np.searchsorted(self._el, t_next, side='left'),
+                   len(self._el) - 1)
+        self._rows, self._el = self._rows[keep:], self._el[keep:]
+        return out
+
+    def finish(self):
+        if self._rows is None:
+            return np.zeros((0, 0)), np.zeros((0,))
+        n_total = int(np.ceil(float(self._rows[-1,0] - self.first_time) / self.dt))
+        if n_total <= self._k:
+            return np.zeros((0, self._rows.shape[1])), np.zeros((0,))
+        return self._take(n_total)
+#}}}
+
+#{{{ chunked_hits
+def chunked_hits(cname, pth, chunksize=100000, nchannels=6, movavg_len=61,
+                 pre_skip=10, steps=50, fixed_offset=None, thr=None):
+    '''
+    a bounded-memory pass over the IR data of a casu log, giving the same
+    hits and ma_hits as SingleLogDataOwner's compute_thresh + compute_hits
+    (with LogDataOwner's zero-padded moving average).
+
+    yields dicts with t, hits and ma_hits for consecutive blocks of
+    samples.  The thresholds used are those given, or guessed from the
+    start of the log.
+    '''
+    th = ChunkedThreshold(nchannels=nchannels, steps=steps, pre_skip=pre_skip,
+                          offset=fixed_offset)
+    ma = ChunkedRollingMean(movavg_len, edges='zero')
+    held = []        # chunks waiting for the thresholds
+    pend_t, pend_h = [], []
+
+    def process(ir):
+        hits = (ir[:, 1:1+nchannels] > thr[:nchannels]).sum(axis=1)
+        pend_t.append(ir[:,0])
+        pend_h.append(hits)
+        return ma.update(hits)
+
+    def emit(ma_hits):
+        if not len(ma_hits):
+            return None
+        t = np.concatenate(pend_t)
+        h = np.concatenate(pend_h)
+        k = len(ma_hits)
+        del pend_t[:], pend_h[:]
+        pend_t.append(t[k:])
+        pend_h.append(h[k:])
+        return {'t': t[:k], 'hits': h[:k], 'ma_hits': ma_hits / float(nchannels)}
+
+    for ir in iter_log_chunks(cname, pth, field='ir', chunksize=chunksize):
+        if thr is None:
+            held.append(ir)
+            if th.update(ir[:, 1:1+nchannels]) is None:
+                continue
+            thr = th.thr
+        else:
+            held.append(ir)
+        for _ir in held:
+            blk = emit(process(_ir))
+            if blk is not None:
+                yield blk
+        held = []
+
+    if thr is None and len(held):
+        thr = th.finish()
+        for _ir in held:
+            blk = emit(process(_ir))
+            if blk is not None:
+                yield blk
+
+    blk = emit(ma.finish())
+    if blk is not None:
+        yield blk
+#}}}
@@ -0,0 +1,173 @@
+'''
+Compact storage of the series loaded by the data owners.
+
+By default every series is a float64 (samples, 1+channels) array, with
+time in column 0.  Under a compact dtype policy, each series is instead a
+TimedArray: the timestamps as one float64 vector and the values as one
+contiguous block of a smaller dtype -- integers for IR (int16 or uint16,
+whichever holds the data exactly) and float32 for the temperatures etc.
+For IR this is ~2.8x smaller, for the 9-sensor temperatures ~1.8x.
+
+A TimedArray indexes like the float64 array it replaces, so analysis code
+does not change:
+    ir[:, 1:7]     -> int16 (samples, 6) view of the values
+    ir[:, 0]       -> float64 timestamps
+    ir[a:b]        -> TimedArray of those rows
+    np.asarray(ir) -> the full float64 array (a copy)
+
+e.g.
+    ldo = LogDataOwner(spec, dtypes='compact')
+
+'''
+
+import numpy as np
+
+# value dtypes per field; 'int' means the smallest of INT_DTYPES that holds
+# the data exactly (else the data is left as float64)
+COMPACT = {
+    'ir':    'int',
+    'temps': np.float32,
+    'pelt':  np.float32,
+    'led':   np.float32,
+    'air':   np.float32,
+}
+INT_DTYPES = [np.int16, np.uint16, np.int32]
+
+DTYPE_POLICIES = {
+    'float64': {},
+    'compact': COMPACT,
+}
+
+#{{{ TimedArray
+class TimedArray(object):
+    '''
+    a (samples, 1+channels) series held as float64 times `t` and a
+    contiguous (samples, channels) block of values `v`.
+    '''
+    def __init__(self, t, v):
+        self.t = np.ascontiguousarray(t, dtype=float)
+        self.v = np.ascontiguousarray(v)
+        if self.v.ndim == 1:
+            self.v = self.v[:, None]
+        if len(self.t) != len(self.v):
+            raise ValueError("[E] {} times for {} rows of values".format(
+                len(self.t), len(self.v)))
+
+    @property
+    def shape(self):
+        return (len(self.t), 1 + self.v.shape[1])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def dtype(self):
+        ''' dtype of the equivalent full array '''
+        return np.result_type(self.t, self.v)
+
+    @property
+    def nbytes(self):
+        return self.t.nbytes + self.v.nbytes
+
+    def __len__(self):
+        return len(self.t)
+
+    def __repr__(self):
+        return "TimedArray({} rows, values {} x {})".format(
+            len(self), self.v.shape[1], self.v.dtype)
+
+    def __array__(self, dtype=None):
+        out = np.empty(self.shape, dtype=dtype or float)
+        out[:,0] = self.t
+        out[:,1:] = self.v
+        return out
+
+    def take(self, indices, axis=None):
+        ''' rows (axis 0) as a float64 array, e.g. for np.take '''
+        if axis != 0:
+            return np.take(self.__array__(), indices, axis=axis)
+        return np.column_stack((self.t[indices], self.v[indices]))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) == 1:
+            rows = key[0]
+            if rows is Ellipsis:
+                return self
+            if np.ndim(rows) == 0 and not isinstance(rows, slice):
+                # one row, as a float64 vector
+                return np.concatenate(([self.t[rows]], self.v[rows]))
+            return TimedArray(self.t[rows], self.v[rows])
+        if len(key) > 2:
+            raise IndexError("[E] too many indices for a TimedArray")
+
+        rows, cols = key
+        c = np.arange(self.shape[1])[cols]
+        if np.ndim(c) == 0:
+            return self.t[rows] if c == 0 else self.v[rows, c - 1]
+        if len(c) and c[0] > 0 and np.all(np.diff(c) == 1):
+            # a run of value columns: a view where rows allow it
+            return self.v[rows, c[0] - 1:c[-1]]
+        return self.__array__()[key]
+#}}}
+
+#{{{ applying a policy
+def _int_dtype(v):
+    ''' smallest integer dtype holding v exactly, or None '''
+    if not len(v) or not np.all(np.isfinite(v)) or np.any(v != np.round(v)):
+        return None
+    lo, hi = v.min(), v.max()
+    for dt in INT_DTYPES:
+        info = np.iinfo(dt)
+        if info.min <= lo and hi <= info.max:
+            return dt
+    return None
+
+def compact_series(arr, vdtype):
+    '''
+    a TimedArray version of the (samples, 1+channels) array `arr`, with
+    values of dtype `vdtype` ('int' picks an integer dtype that is
+    lossless, if there is one).  None, empty or 1-d input, or 'int' data
+    that are not integers, are returned unchanged.
+    '''
+    if arr is None or isinstance(arr, TimedArray):
+        return arr
+    arr = np.asarray(arr)
+    if arr.ndim != 2 or arr.shape[1] < 2 or arr.shape[0] == 0:
+        return arr
+    v = arr[:, 1:]
+    if vdtype == 'int':
+        vdtype = _int_dtype(v)
+        if vdtype is None:
+            print "   [W] values are not small integers, kept as {}".format(
+                arr.dtype)
+            return arr
+    return TimedArray(arr[:, 0], v.astype(vdtype))
+
+def get_policy(dtypes):
+    '''
+    resolve a dtype policy: None or a name in DTYPE_POLICIES, or a dict of
+    field -> value dtype (fields not named are kept as float64).
+    '''
+    if dtypes is None:
+        return {}
+    if isinstance(dtypes, dict):
+        return dtypes
+    if dtypes not in DTYPE_POLICIES:
+        raise ValueError("[E] unknown dtype policy '{}' (use one of {})".format(
+            dtypes, sorted(DTYPE_POLICIES.keys())))
+    return DTYPE_POLICIES[dtypes]
+
+def apply_policy(data, policy, keys=None):
+    ''' convert the entries `keys` (default all) of dict `data` in place '''
+    for k in (keys if keys is not None else policy.keys()):
+        if k in policy and dict.get(data, k) is not None:
+            data[k] = compact_series(dict.get(data, k), policy[k])
+    return data
+#}}}
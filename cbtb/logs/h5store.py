@@ -0,0 +1,196 @@
+'''
+Export loaded experiments to one HDF5 file, and load back selected parts.
+
+The file is partitioned by experiment and casu:
+
+    /<experiment>/<casu>/             attrs: layer, ctype, data_dir, t0, tEnd,
+                                             t_offset_temps
+    /<experiment>/<casu>/ir/t         float64 times      (chunked, compressed)
+    /<experiment>/<casu>/ir/v         values, as loaded (e.g. int16 if compact)
+    /<experiment>/<casu>/temps/...    same for temps, pelt, led, air
+    /<experiment>/<casu>/sync         sync events
+    /<experiment>/<casu>/thr          thresholds
+    /<experiment>/<casu>/hits, ma_hits   row-aligned with ir
+
+so that load_nodes can read only the nodes, fields and time window asked
+for; rows in a window are found by bisecting the time vector.  Exporting
+an experiment again replaces only its own casu groups.
+
+e.g.
+    ldo.read_data(); ldo.compute_thresh(); ldo.compute_hits()
+    h5store.export_owner(ldo, "lab.h5")
+    ...
+    nodes = h5store.load_nodes("lab.h5", "expA/run1", nodes=['casu-001'],
+                               fields=['ir', 'ma_hits'], t_start=t0 + 60)
+
+Needs h5py.
+'''
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from compact import TimedArray
+
+SERIES_FIELDS = ['ir', 'temps', 'pelt', 'led', 'air']
+# arrays with one row per ir sample
+IR_ROW_FIELDS = ['hits', 'ma_hits', 'above_thr']
+PLAIN_FIELDS = ['sync', 'thr']
+NODE_ATTRS = ['layer', 'ctype', 'data_dir', 't0', 'tEnd', 't_offset_temps']
+
+def _need_h5py():
+    if h5py is None:
+        raise ImportError("[E] h5py is needed to read or write experiment stores")
+
+#{{{ export
+def _write(grp, name, arr, compression, chunk_rows):
+    arr = np.asarray(arr)
+    chunks = None
+    if arr.ndim and arr.shape[0] > 0:
+        chunks = (min(chunk_rows, arr.shape[0]),) + arr.shape[1:]
+    grp.create_dataset(name, data=arr, chunks=chunks,
+                       compression=compression if chunks else None,
+                       shuffle=bool(chunks and compression))
+
+def export_nodes(nodes, h5file, experiment, attrs=None, fields=None,
+                 compression='gzip', chunk_rows=65536):
+    '''
+    write a dict node -> data dict (as LogDataOwner.nodes) into the group
+    `experiment` of `h5file`.  Existing groups of the same nodes are
+    replaced; other nodes and experiments are left alone.
+    '''
+    _need_h5py()
+    with h5py.File(h5file, 'a') as f:
+        eg = f.require_group(experiment)
+        for k, v in (attrs or {}).items():
+            if v is not None:
+                eg.attrs[k] = v
+        for node in sorted(nodes):
+            d = nodes[node]
+            if node in eg:
+                del eg[node]
+            ng = eg.create_group(node)
+            for k in NODE_ATTRS:
+                if d.get(k) is not None:
+                    ng.attrs[k] = d[k]
+
+            for k in SERIES_FIELDS:
+                if (fields is not None and k not in fields) or d.get(k) is None:
+                    continue
+                s = d[k]
+                if not isinstance(s, TimedArray):
+                    s = np.asarray(s)
+                    s = TimedArray(s[:,0], s[:,1:])
+                sg = ng.create_group(k)
+                _write(sg, 't', s.t, compression, chunk_rows)
+                _write(sg, 'v', s.v, compression, chunk_rows)
+
+            for k in IR_ROW_FIELDS + PLAIN_FIELDS:
+                if (fields is not None and k not in fields) or d.get(k) is None:
+                    continue
+                _write(ng, k, d[k], compression, chunk_rows)
+
+def export_owner(owner, h5file, experiment=None, fields=None,
+                 compression='gzip', chunk_rows=65536):
+    '''
+    write the data of a LogDataOwner (all of its nodes) or a
+    SingleLogDataOwner into `h5file`.  The experiment name defaults to
+    <base>/<label> of the spec, or the log directory for a single casu.
+    '''
+    if hasattr(owner, 'nodes'):
+        nodes = owner.nodes
+        attrs = {'base': owner.spec.get('base'), 'label': owner.spec.get('label'),
+                 'proj_name': owner.proj_name, 'pth': owner.pth}
+        if experiment is None:
+            experiment = "{}/{}".format(owner.spec['base'], owner.spec['label'])
+    else:
+        d = dict((k, dict.get(owner.data, k)) for k in owner.data)
+        d.update({'ctype': owner.ctype, 'data_dir': owner.pth,
+                  't0': owner._t0, 'tEnd': owner._tEnd})
+        nodes = {owner.cname: d}
+        attrs = {'pth': owner.pth}
+        if experiment is None:
+            experiment = owner.pth.strip('/')
+    export_nodes(nodes, h5file, experiment, attrs=attrs, fields=fields,
+                 compression=compression, chunk_rows=chunk_rows)
+    print "[I] exported {} nodes to {}:/{}".format(len(nodes), h5file, experiment)
+    return experiment
+#}}}
+
+#{{{ query
+def _bisect(tds, t, lo=0):
+    ''' first row of the (time-ordered) dataset tds with time >= t '''
+    hi = tds.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if tds[mid] < t:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _rows(tds, t_start, t_stop):
+    a = 0 if t_start is None else _bisect(tds, t_start)
+    b = tds.shape[0] if t_stop is None else _bisect(tds, t_stop, lo=a)
+    return a, b
+
+def experiments(h5file):
+    ''' names of the experiments in a store (groups holding casu groups) '''
+    _need_h5py()
+    found = []
+    with h5py.File(h5file, 'r') as f:
+        def visit(name, obj):
+            # casu groups are the ones with a ctype
+            if isinstance(obj, h5py.Group) and 'ctype' in obj.attrs:
+                parent = name.rsplit('/', 1)[0] if '/' in name else ''
+                if parent not in found:
+                    found.append(parent)
+        f.visititems(visit)
+    return sorted(found)
+
+def load_nodes(h5file, experiment, nodes=None, fields=None, t_start=None,
+               t_stop=None, compact=False):
+    '''
+    read back (part of) an experiment: the `nodes` and `fields` listed
+    (default all), and for the time series only the rows with
+    t_start <= t < t_stop (times on each casu's own clock).
+
+    returns a dict node -> data dict, as LogDataOwner.nodes.  Series are
+    float64 arrays, or with compact=True TimedArray's with the values in
+    their stored dtype.
+    '''
+    _need_h5py()
+    want = lambda k: fields is None or k in fields
+    want_ir_rows = any(want(k) for k in IR_ROW_FIELDS)
+    out = {}
+    with h5py.File(h5file, 'r') as f:
+        eg = f[experiment]
+        for node in sorted(eg.keys()):
+            if nodes is not None and node not in nodes:
+                continue
+            ng = eg[node]
+            d = dict((k, ng.attrs[k]) for k in NODE_ATTRS if k in ng.attrs)
+            ir_rows = (None, None)
+            for k in SERIES_FIELDS:
+                # ir rows are also needed to window hits/ma_hits
+                if k not in ng or not (want(k) or (k == 'ir' and want_ir_rows)):
+                    continue
+                a, b = _rows(ng[k]['t'], t_start, t_stop)
+                if k == 'ir':
+                    ir_rows = (a, b)
+                if want(k):
+                    s = TimedArray(ng[k]['t'][a:b], ng[k]['v'][a:b])
+                    d[k] = s if compact else np.asarray(s)
+
+            for k in IR_ROW_FIELDS:
+                if k in ng and want(k):
+                    d[k] = ng[k][ir_rows[0]:ir_rows[1]]
+            for k in PLAIN_FIELDS:
+                if k in ng and want(k):
+                    d[k] = ng[k][...]
+            out[node] = d
+    return out
+#}}}
@@ -0,0 +1,147 @@
+'''
+A persistent sidecar cache of parsed casu log series.
+
+Each parsed series is stored as a raw .npy file (so it can be memory-mapped
+on load) inside a cache directory belonging to the source log file.  The
+directory holds a small yaml index with the size and mtime of the source,
+plus the parser version; any mismatch invalidates the whole entry.
+
+By default the cache sits next to the log:
+    <logdir>/<logname>.cbtb-cache/
+or, if `cache_dir` is given, in
+    <cache_dir>/<hash of logdir>-<logname>.cbtb-cache/
+
+'''
+
+import os, hashlib, yaml
+import numpy as np
+
+# bump whenever the parsing of any series changes, to invalidate old caches
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".cbtb-cache"
+INDEX_FILE = "index.yaml"
+
+#{{{ locations and validity
+def entry_dir(srcfile, cache_dir=None):
+    '''
+    directory that holds the cached arrays for `srcfile`
+    '''
+    src = os.path.abspath(srcfile)
+    base = os.path.basename(src) + CACHE_SUFFIX
+    if cache_dir is None:
+        return os.path.join(os.path.dirname(src), base)
+
+    # several casu logs can share a name across layers; disambiguate by dir
+    h = hashlib.md5(os.path.dirname(src).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(cache_dir, "{}-{}".format(h, base))
+
+def _stamp(srcfile):
+    st = os.stat(srcfile)
+    return {'size': int(st.st_size), 'mtime': float(st.st_mtime)}
+
+def _read_index(edir, srcfile, tag):
+    '''
+    return the index of a valid cache entry, or None if it is missing/stale
+    '''
+    idx_file = os.path.join(edir, INDEX_FILE)
+    if not os.path.exists(idx_file):
+        return None
+    try:
+        with open(idx_file) as f:
+            idx = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError):
+        return None
+
+    if not isinstance(idx, dict):
+        return None
+    if idx.get('version') != CACHE_VERSION or idx.get('tag') != tag:
+        return None
+    if idx.get('source') != _stamp(srcfile):
+        return None
+    return idx
+#}}}
+
+#{{{ load / store
+def load(srcfile, keys, cache_dir=None, tag=None, mmap_mode='c'):
+    '''
+    load the series named in `keys` from the cache for `srcfile`.
+
+    Arrays are memory-mapped (copy-on-write by default, so callers may
+    still modify them in memory); scalar values (e.g. t0, tEnd) are returned
+    as floats.  Returns None if the entry is missing, stale, or does not
+    hold all of the requested keys.
+    '''
+    edir = entry_dir(srcfile, cache_dir)
+    idx = _read_index(edir, srcfile, tag)
+    if idx is None:
+        return None
+
+    arrays = idx.get('arrays', [])
+    scalars = idx.get('scalars', {})
+    for k in keys:
+        if k not in arrays and k not in scalars:
+            return None
+
+    data = {}
+    for k in keys:
+        if k in arrays:
+            data[k] = np.load(os.path.join(edir, k + ".npy"),
+                              mmap_mode=mmap_mode)
+        else:
+            data[k] = scalars[k]
+    return data
+
+def store(srcfile, data, cache_dir=None, tag=None):
+    '''
+    write the arrays and scalars in `data` to the cache for `srcfile`.
+    Entries with value None are skipped.  If a valid entry already exists,
+    the new series are added to it; otherwise it is replaced.
+
+    Failure to write (e.g. a read-only archive) is reported but not raised.
+    '''
+    edir = entry_dir(srcfile, cache_dir)
+    try:
+        if not os.path.isdir(edir):
+            os.makedirs(edir)
+
+        idx = _read_index(edir, srcfile, tag)
+        if idx is None:
+            idx = {'version': CACHE_VERSION, 'tag': tag,
+                   'source': _stamp(srcfile), 'arrays': [], 'scalars': {}}
+
+        for k, v in data.items():
+            if v is None:
+                continue
+            if isinstance(v, np.ndarray):
+                # rename into place: other owners may have the old file mapped
+                fn = os.path.join(edir, k + ".npy")
+                with open(fn + ".tmp", 'wb') as f:
+                    np.save(f, np.asarray(v))
+                os.rename(fn + ".tmp", fn)
+                if k not in idx['arrays']:
+                    idx['arrays'].append(k)
+            else:
+                idx['scalars'][k] = float(v)
+
+        # write index last, via a rename, so a partial write is never valid
+        tmp = os.path.join(edir, INDEX_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            yaml.safe_dump(idx, f, default_flow_style=False)
+        os.rename(tmp, os.path.join(edir, INDEX_FILE))
+    except (IOError, OSError) as e:
+        print "[W] could not write cache for {} ({})".format(srcfile, e)
+        return False
+
+    return True
+
+def clear(srcfile, cache_dir=None):
+    '''
+    remove the cache entry for `srcfile`, if present
+    '''
+    edir = entry_dir(srcfile, cache_dir)
+    if not os.path.isdir(edir):
+        return
+    for fn in os.listdir(edir):
+        os.remove(os.path.join(edir, fn))
+    os.rmdir(edir)
+#}}}
@@ -2,8 +2,143 @@
 A library to assist with parsing and processing logs from casu output
 '''
 
-import yaml, os, fnmatch
+import yaml, os, fnmatch, io, gzip, bz2, collections
 import numpy as np
+import rolling
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma # pip install backports.lzma for python2
+    except ImportError:
+        lzma = None
+
+#{{{ compressed logs
+# suffixes of logs that are read with streaming decompression
+COMPRESSED_EXTS = ['.gz', '.bz2', '.xz']
+
+def is_compressed(fn):
+    return os.path.splitext(fn)[1] in COMPRESSED_EXTS
+
+def open_log(path):
+    '''
+    open a log for reading lines, decompressing on the fly if the name
+    ends in .gz, .bz2 or .xz.
+    '''
+    ext = os.path.splitext(path)[1]
+    if ext == '.gz':
+        # the buffered wrapper makes line iteration fast under python 2
+        return io.BufferedReader(gzip.GzipFile(path, 'rb'))
+    elif ext == '.bz2':
+        return bz2.BZ2File(path, 'r')
+    elif ext == '.xz':
+        if lzma is None:
+            raise IOError("[E] reading {} needs the lzma module "
+                          "(backports.lzma under python 2)".format(path))
+        return lzma.LZMAFile(path, 'r')
+    return open(path, 'r')
+
+def tail_log(path, window=20):
+    '''
+    last `window` lines of the log at path.  For plain files this seeks
+    back from the end (see tail); compressed streams cannot seek
+    backwards cheaply, so they are decompressed once while only the last
+    lines are kept.
+    '''
+    if not is_compressed(path):
+        with open(path, 'r') as f:
+            return tail(f, window)
+    if window == 0:
+        return []
+    with open_log(path) as f:
+        last = collections.deque(f, maxlen=window)
+    return [l.rstrip('\r\n') for l in last]
+#}}}
+
+#{{{ directory index
+class DirIndex(object):
+    '''
+    listing of one data directory, read once and shared by all lookups of
+    casu logs and sync logs in it (see get_dir_index).  Lookups per casu
+    are memoised; if several files match, the first (in listing order, as
+    os.listdir would give) is used and a warning is printed.  If there is
+    no plain log, a compressed one (.gz, .bz2, .xz) is looked for.  A
+    lookup that finds nothing re-reads the listing once before giving up.
+    '''
+    log_pattern = '*{}.csv'
+    sync_pattern = '{}*.sync.log'
+
+    def __init__(self, pth):
+        self.pth = pth
+        self._warned = set()
+        self.rescan()
+
+    def rescan(self):
+        ''' re-read the listing, and forget memoised lookups '''
+        # stat first: a change during the listdir then shows up next time
+        self.mtime = os.stat(self.pth).st_mtime
+        self.files = os.listdir(self.pth)
+        self._hits = {}
+
+    def matches(self, pattern):
+        ''' all files matching the (fnmatch) pattern '''
+        if pattern not in self._hits:
+            self._hits[pattern] = fnmatch.filter(self.files, pattern)
+        return self._hits[pattern]
+
+    def _first_match(self, patterns):
+        for pattern in patterns:
+            hits = self.matches(pattern)
+            if len(hits):
+                return pattern, hits
+        return None, []
+
+    def _unique(self, pattern, what, cname, compressed=True):
+        # plain files first, then any compressed copies
+        patterns = [pattern]
+        if compressed:
+            patterns += [pattern + ext for ext in COMPRESSED_EXTS]
+        pattern, hits = self._first_match(patterns)
+        if len(hits) == 0:
+            # a file created within the same mtime tick as the listing (1-2 s
+            # on some filesystems) leaves the mtime unchanged; look again
+            self.rescan()
+            pattern, hits = self._first_match(patterns)
+        if len(hits) == 0:
+            return None
+        if len(hits) > 1 and pattern not in self._warned:
+            self._warned.add(pattern)
+            print "[W] ambiguous {} for {} in {}: {} -- using {}".format(
+                what, cname, self.pth, hits, hits[0])
+        return hits[0]
+
+    def casu_log(self, cname, compressed=True):
+        return self._unique(self.log_pattern.format(cname), "casu log",
+                            cname, compressed)
+
+    def sync_log(self, cname, compressed=True):
+        return self._unique(self.sync_pattern.format(cname), "sync log",
+                            cname, compressed)
+
+    def ambiguous(self):
+        ''' dict of pattern -> matches, for lookups that hit >1 file '''
+        return dict((p, h) for (p, h) in self._hits.items() if len(h) > 1)
+
+_dir_indexes = {}
+
+def get_dir_index(pth, refresh=False):
+    '''
+    return the shared DirIndex for directory `pth`, building it on first
+    use.  The listing is re-read if the directory mtime has changed (one
+    stat per call), if refresh is True, or when a lookup finds nothing.
+    '''
+    key = os.path.abspath(pth)
+    idx = _dir_indexes.get(key)
+    if idx is None or refresh or os.stat(pth).st_mtime != idx.mtime:
+        idx = DirIndex(pth)
+        _dir_indexes[key] = idx
+    return idx
+#}}}
 
 #{{{ read specific data series from file
 def read_syncflash(cname, pth='./'):
@@ -12,19 +147,12 @@ def read_syncflash(cname, pth='./'):
     a similar form, with datestamp in fname.
     look for the file that matches, and read all lines into an array.
     '''
-    # find the first hit for this casu name
-    found = False
-    for fn in os.listdir(pth):
-        if fnmatch.fnmatch(fn, '{}*.sync.log'.format(cname)):
-            print "[I] found sync log {} -> {}".format(cname, fn)
-            found = True
-            break
-
-    if not found:
+    fn = identify_synclog(cname, pth, verb=True)
+    if fn is None:
         return None
 
     li = []
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if len(line.split(';')) >=3:
                 if line.strip('; \n').endswith('start'):
@@ -45,7 +173,7 @@ def read_irs(cname, pth='./', verb=False, minlen=8, droptail=True):
     #temp_lines = []
     #peltier_lines = []
     skipped = 0
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if line.startswith('ir_raw'):
                 if len(line.split(';')) >= minlen:
@@ -69,12 +197,17 @@ def read_irs(cname, pth='./', verb=False, minlen=8, droptail=True):
 
 def identify_log(cname, pth, verb=False):
     # find the first hit for this casu name
-    for fn in os.listdir(pth):
-        if fnmatch.fnmatch(fn, '*{}.csv'.format(cname)):
-            if verb: print "[I] found casu log {} -> {}".format(cname, fn)
-            return fn
-    # got this far, not found
-    return None
+    fn = get_dir_index(pth).casu_log(cname)
+    if fn is not None and verb:
+        print "[I] found casu log {} -> {}".format(cname, fn)
+    return fn
+
+def identify_synclog(cname, pth, verb=False):
+    # find the first hit for this casu name
+    fn = get_dir_index(pth).sync_log(cname)
+    if fn is not None and verb:
+        print "[I] found sync log {} -> {}".format(cname, fn)
+    return fn
 
 def read_temp_sensor_vals(cname, pth, minlen=7, droptail=True):
     fn = identify_log(cname, pth)
@@ -86,7 +219,7 @@ def read_temp_sensor_vals(cname, pth, minlen=7, droptail=True):
     # extract lines that are about temps
     # we'll store separately and let csvreaders on the job. (or numpy)
     temp_lines = []
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if line.startswith('temp'):
                 if len(line.split(';')) >= minlen:
@@ -102,7 +235,7 @@ def read_air_data(cname, pth, droptail=True):
     fn = identify_log(cname, pth)
     # extract lines that are about LED states/changes
     air_lines = []
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if line.startswith('airflow_ref;'):
                 if len(line.split(';')) == 3:
@@ -117,7 +250,7 @@ def read_led_data(cname, pth, droptail=True):
     fn = identify_log(cname, pth)
     # extract lines that are about LED states/changes
     led_lines = []
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if line.startswith('dled_ref;'):
                 if len(line.split(';')) == 5:
@@ -135,7 +268,7 @@ def read_peltier_data(cname, pth):
 
     # extract lines that are about peltier state changes
     peltier_lines = []
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         for line in f:
             if line.startswith('Peltier;'):
                 if len(line.split(';')) == 4:
@@ -158,9 +291,9 @@ def read_tstart_tstop(cname, pth):
     find the first and last line in log, as the t0 and tEnd bounds
     '''
     fn = identify_log(cname, pth)
-    with open(os.path.join(pth, fn), 'r') as f:
+    with open_log(os.path.join(pth, fn)) as f:
         line1 = f.readline()
-        last2 = tail(f, 2)
+    last2 = tail_log(os.path.join(pth, fn), 2)
 
 
     # we take the last but one because sometimes the last line seems corrupted
@@ -173,29 +306,219 @@ def read_tstart_tstop(cname, pth):
 
 #}}}
 
-
-#{{{ which_arena
-def which_arena(proj_file, search_casu):
+#{{{ single-pass reader for all series in a casu log
+# record prefix -> (key in returned dict, field-count rule, strip line, droptail)
+# the rules replicate those of the individual readers above.
+LOG_RECORDS = [
+    ('ir',   'ir_raw',       '>=', True,  True),
+    ('temp', 'temp',         '>=', True,  True),
+    ('pelt', 'Peltier;',     '==', False, False),
+    ('led',  'dled_ref;',    '==', False, True),
+    ('air',  'airflow_ref;', '==', False, True),
+]
+LOG_NFIELDS = {'ir': 8, 'temp': 7, 'pelt': 4, 'led': 5, 'air': 3}
+
+def read_all_series(cname, pth, fields=None, minlens=None, droptail=True,
+                    verb=False, usecols=None, block=65536):
     '''
-    find which arena the casu is in, within the assisi project proj
+    read the casu log once, and distribute each line to the buffer for its
+    record type (ir_raw, temp, Peltier;, dled_ref;, airflow_ref;).  The same
+    field-count filters and tail-dropping rules as read_irs,
+    read_temp_sensor_vals, etc are applied.
+
+    `fields` restricts which record types are kept (default: all of
+    LOG_RECORDS keys); `minlens` is a dict that overrides the number of
+    fields needed for a line to be kept (e.g. {'temp': 10} for phys casus).
+
+    `usecols` is an optional dict of record type -> columns; those record
+    types are parsed (with parse_records) every `block` lines, so that the
+    text is not kept in memory, and returned as arrays.
+
+    returns a dict of lists of lines (or arrays) per record type, plus the
+    extreme time values in the log under 't0' and 'tEnd' (as
+    read_tstart_tstop).
     '''
+    fn = identify_log(cname, pth, verb=verb)
+    if fn is None:
+        raise IOError("[E] no casu log found for {} in {}".format(cname, pth))
+
+    nf = dict(LOG_NFIELDS)
+    if minlens is not None:
+        nf.update(minlens)
+    if usecols is None:
+        usecols = {}
+
+    rules = []
+    for (key, prefix, op, strip, drop) in LOG_RECORDS:
+        if fields is None or key in fields:
+            rules.append((key, prefix, nf[key], op == '>=', strip))
+
+    bufs = dict((r[0], []) for r in rules)
+    parsed = dict((k, []) for k in bufs if k in usecols)
+    nlines = dict((r[0], 0) for r in rules)
+    skipped = dict((r[0], 0) for r in rules)
+    first, prev, last = None, None, None
+    with open_log(os.path.join(pth, fn)) as f:
+        for line in f:
+            if first is None:
+                first = line
+            prev, last = last, line
+            for (key, prefix, n, at_least, strip) in rules:
+                if line.startswith(prefix):
+                    nfields = line.count(';') + 1
+                    if (at_least and nfields >= n) or nfields == n:
+                        buf = bufs[key]
+                        buf.append(line.strip() if strip else line)
+                        nlines[key] += 1
+                        if key in parsed and len(buf) > block:
+                            # keep the latest line back, it may be the tail
+                            parsed[key].append(
+                                _parse_block(buf[:-1], usecols[key]))
+                            del buf[:-1]
+                    else:
+                        skipped[key] += 1
+                    break
+
+    for (key, prefix, op, strip, drop) in LOG_RECORDS:
+        if key in bufs and droptail and drop and len(bufs[key]):
+            # discard last one - very frequently malformed
+            bufs[key].pop()
+            nlines[key] -= 1
+
+    for key in parsed:
+        if len(bufs[key]):
+            parsed[key].append(_parse_block(bufs[key], usecols[key]))
+        if len(parsed[key]):
+            bufs[key] = np.squeeze(np.concatenate(parsed[key]))
+        else:
+            bufs[key] = np.empty((0, len(usecols[key])))
+
+    print "   [i] read {} from {} in one pass".format(
+        ", ".join(["{} {}".format(nlines[k], k) for k in sorted(bufs)]), fn)
+    if verb and sum(skipped.values()):
+        print "   [i] skipped lines (too short): {}".format(skipped)
+
+    # we take the last but one because sometimes the last line seems corrupted
+    if prev is None:
+        prev = last
+    bufs['t0'] = float(first.split(";")[1]) if first is not None else None
+    bufs['tEnd'] = float(prev.split(";")[1]) if prev is not None else None
+    return bufs
+#}}}
 
-    #proj_file = os.path.join(p_root, depdir, pf)
-    proj_dir = os.path.dirname(os.path.abspath(proj_file))
-    with open(proj_file) as _f:
-        project = yaml.safe_load(_f)
+#{{{ fast parsing of casu records
+def _parse_block(lines, usecols):
+    '''
+    parse the columns `usecols` of ;-separated records into a 2d float
+    array.  The first field (record name) is dropped, and the remainder of
+    all lines is handed to the numpy tokenizer in one string.
+    '''
+    cols = np.asarray(usecols, dtype=int) - 1
+    nrows = len(lines)
+    counts = [l.count(';') for l in lines]
+    if counts.count(counts[0]) == nrows:
+        # all records the same length: only strip the record name
+        ncols = counts[0]
+        blob = ';'.join([l.partition(';')[2] for l in lines])
+    else:
+        # ragged records (e.g. ir lines with extra fields): cut each one to
+        # the columns needed
+        ncols = cols.max() + 1
+        blob = ';'.join([';'.join(l.split(';', ncols + 1)[1:ncols + 1])
+                         for l in lines])
+
+    # whitespace in sep allows for newlines left at the end of records
+    vals = np.fromstring(blob, sep=' ;')
+    if vals.size != nrows * ncols:
+        # something non-numeric or missing; let loadtxt parse (or complain)
+        return np.loadtxt(lines, usecols=usecols, delimiter=';', ndmin=2)
+    return vals.reshape(nrows, ncols)[:, cols]
+
+def parse_records(lines, usecols, block=65536):
+    '''
+    fast replacement for np.loadtxt(lines, usecols=usecols, delimiter=';')
+    on casu log records, giving identical values.  Lines are parsed in
+    blocks into one preallocated array.
 
-    af = project.get('arena')
-    with open(os.path.join(proj_dir, af)) as _f:
-        arena = yaml.safe_load(_f)
+    As loadtxt, a single record is returned as a 1d array; no records give
+    an empty (0, len(usecols)) array.
+    '''
+    out = np.empty((len(lines), len(usecols)))
+    for i in xrange(0, len(lines), block):
+        out[i:i + block] = _parse_block(lines[i:i + block], usecols)
+    return np.squeeze(out) if len(lines) == 1 else out
+#}}}
 
-    for layer in sorted(arena):
-        for _casu in arena[layer]:
-            if _casu == search_casu:
-                return layer
+#{{{ which_arena
+class ArenaProject(object):
+    '''
+    an assisi project file and the arena file it refers to, parsed once.
+    Holds the whole arena topology (layer -> casus) plus a casu -> layer
+    map, so that looking up many casus is cheap (see load_project).
+    '''
+    def __init__(self, proj_file):
+        self.proj_file = os.path.abspath(proj_file)
+        self.proj_dir = os.path.dirname(self.proj_file)
+        with open(self.proj_file) as _f:
+            self.project = yaml.safe_load(_f)
+
+        af = self.project.get('arena')
+        self.arena_file = os.path.join(self.proj_dir, af)
+        with open(self.arena_file) as _f:
+            self.arena = yaml.safe_load(_f)
+
+        # as in a linear search over sorted layers, the first layer wins
+        self.layers = sorted(self.arena)
+        self.casu_layer = {}
+        for layer in self.layers:
+            for _casu in (self.arena[layer] or []):
+                self.casu_layer.setdefault(_casu, layer)
+        self._mtimes = self._stamp()
+
+    def which_arena(self, search_casu):
+        ''' layer that casu is in, or None if not in the arena '''
+        return self.casu_layer.get(search_casu)
+
+    def casus(self, layer=None):
+        ''' sorted list of casus, in one layer or in all layers '''
+        if layer is not None:
+            return sorted(self.arena.get(layer) or [])
+        return sorted(self.casu_layer)
+
+    def topology(self):
+        ''' dict of layer -> sorted list of casus '''
+        return dict((layer, self.casus(layer)) for layer in self.layers)
+
+    def _stamp(self):
+        return (os.stat(self.proj_file).st_mtime,
+                os.stat(self.arena_file).st_mtime)
+
+_projects = {}
+
+def load_project(proj_file):
+    '''
+    return the parsed ArenaProject for proj_file, memoised while neither
+    the project file nor its arena file change.
+    '''
+    key = os.path.abspath(proj_file)
+    proj = _projects.get(key)
+    if proj is not None:
+        try:
+            if proj._stamp() == proj._mtimes:
+                return proj
+        except OSError:
+            pass
+
+    proj = ArenaProject(proj_file)
+    _projects[key] = proj
+    return proj
 
+def which_arena(proj_file, search_casu):
+    '''
+    find which arena the casu is in, within the assisi project proj
+    '''
     # not found = return none.
-    return None
+    return load_project(proj_file).which_arena(search_casu)
 #}}}
 
 
@@ -204,28 +527,95 @@ def guess_ir_thresh(ir_raw, gain=1.1, steps=50, pre_skip=5):
     thr = ir_raw[pre_skip:pre_skip+steps].max() * gain
     return thr
 def guess_ir_with_offset(ir_raw, steps=50, pre_skip=5, offset=300):
-    thr = ir_raw[pre_skip:pre_skip+steps].max() + offset
+    # in float, as compact (int16) data could overflow
+    thr = np.float64(ir_raw[pre_skip:pre_skip+steps].max()) + offset
     return thr
 
 def movingaverage(data, window_size):
-    ''' from http://stackoverflow.com/a/11352216'''
-    window = np.ones(int(window_size))/float(window_size)
-    return np.convolve(data, window, 'same')
+    ''' from http://stackoverflow.com/a/11352216
+    centred window, zero-padded at the edges (as np.convolve 'same');
+    now computed in O(n) by rolling.rolling_mean '''
+    return rolling.rolling_mean(data, window_size, edges='zero')
 
 def movavg2(data, window_size):
     '''https://stackoverflow.com/a/34387987 faster than ma1 '''
-    cs_vec = np.cumsum(np.insert(data, 0, 0))
-    ma_vec = (cs_vec[window_size:] - cs_vec[:-window_size]) / float(window_size)
+    w = int(window_size)
+    ma_vec = rolling.rolling_mean(data, w, edges='valid')
     # padding at start and end -- just take avg value for 1 window so the value
-    # doesn't drop down with zeros.
-    start_v = np.ones(window_size/2 ) * data[:window_size/2].mean()
-    end_v   = np.ones(window_size/2) * data[-window_size/2:].mean()
+    # doesn't drop down with zeros.  (w//2 at start, (w-1)//2 at end, so the
+    # output has the length of the input for odd and even windows alike)
+    data = np.asarray(data, dtype=float)
+    start_v = np.ones(w // 2) * (data[:w // 2].mean() if w > 1 else 0.0)
+    end_v   = np.ones((w - 1) // 2) * data[-(w - w // 2):].mean()
     return np.concatenate( (start_v, ma_vec, end_v))
 
+def movingaverage_nd(data, window_size, axis=-1):
+    '''
+    movingaverage (zero-padded edges) along `axis` of an nd array, e.g.
+    all IR channels in one call.
+    '''
+    return rolling.rolling_mean(data, window_size, axis=axis, edges='zero')
+
+#}}}
+
+#{{{ batched IR processing over many nodes
+def guess_ir_thresh_batch(ir_raws, gain=1.1, steps=50, pre_skip=5, offset=None):
+    '''
+    IR thresholds for all channels of many nodes at once.  `ir_raws` is a
+    list of (samples, channels) arrays, or a (nodes, samples, channels)
+    array.  Only the calibration window [pre_skip:pre_skip+steps] of each
+    node is used, so the nodes need not be aligned.
 
+    As guess_ir_thresh (window max * gain) per channel, or as
+    guess_ir_with_offset (window max + offset) if offset is given.
 
+    returns a (nodes, channels) array.
+    '''
+    wins = [r[pre_skip:pre_skip+steps] for r in ir_raws]
+    if len(set([w.shape for w in wins])) == 1:
+        peak = np.stack(wins).max(axis=1)
+    else:
+        # some node is shorter than the window
+        peak = np.array([w.max(axis=0) for w in wins])
+    # in float, as compact (int16) data could overflow
+    peak = peak.astype(float)
 
+    if offset is None:
+        return peak * gain
+    return peak + offset
 
+def ir_hits_batch(ir_stack, thr, movavg_len=61, packed=False):
+    '''
+    above-threshold masks, hit counts and moving-average hit rates for a
+    (nodes, samples, channels) stack of aligned IR data, with (nodes,
+    channels) thresholds `thr`.
+
+    returns above_thr, hits (nodes, samples) and ma_hits (nodes, samples),
+    where ma_hits is as plg.movingaverage(hits) / channels.  If packed is
+    True, above_thr is bit-packed along the channel axis (see np.packbits
+    and unpack_above): one byte per sample for up to 8 channels, so 6x
+    smaller than the boolean mask for 6 channels (8x only with 8).
+    '''
+    nodes, samples, nch = ir_stack.shape
+    thr = np.asarray(thr)[:, None, :nch]
+    if not packed:
+        above_thr = ir_stack > thr
+        hits = above_thr.sum(axis=2, dtype=np.uint8)
+    else:
+        # one node at a time, so the full boolean mask is never held
+        above_thr = np.empty((nodes, samples, (nch + 7) // 8), dtype=np.uint8)
+        hits = np.empty((nodes, samples), dtype=np.uint8)
+        for i in xrange(nodes):
+            _above = ir_stack[i] > thr[i]
+            hits[i] = _above.sum(axis=1)
+            above_thr[i] = np.packbits(_above, axis=1)
+
+    ma_hits = movingaverage_nd(hits, movavg_len, axis=1) / float(nch)
+    return above_thr, hits, ma_hits
+
+def unpack_above(above_packed, nchannels=6):
+    ''' boolean (..., samples, channels) mask from a bit-packed one '''
+    return np.unpackbits(above_packed, axis=-1)[..., :nchannels].astype(bool)
 #}}}
 
 #{{{ graphics / visualisation
@@ -244,12 +634,52 @@ def min_sec_fmtr(s, pos):
 #}}}
 
 #{{{ sample_signal
-def sample_signal(raw, start_time=None, dt=0.1, t_offset=0.0, verb=0):
+def _sample_times(num_samples, dt):
+    '''
+    the internal clock of sample_signal: latch times (relative to the
+    reference time), and the time reported for each sample.  Accumulated by
+    repeated addition, as the original loop did, so values are identical.
+    '''
+    steps = np.empty((num_samples + 1,))
+    steps[0] = -dt
+    steps[1:] = dt
+    t = np.cumsum(steps)
+    return t[:-1], t[1:]
+
+def _latch_index(times, first_time, t_latch):
+    '''
+    for each latch time, the index of the first sample whose time (relative
+    to first_time) is not before it -- or the last sample if there is none.
+    Equivalent to the forward scan of the original loop, even when times are
+    not monotonic (the running max gives the first sample that reaches t).
+    '''
+    elapsed = np.maximum.accumulate(times - first_time)
+    idx = np.searchsorted(elapsed, t_latch, side='left')
+    return np.minimum(idx, len(times) - 1)
+
+def _sample_onto(raw, first_time, t_latch, method):
+    if method == 'latch':
+        idx = _latch_index(raw[:,0], first_time, t_latch)
+        return np.asarray(np.take(raw, idx, axis=0), dtype=float), idx
+    elif method == 'linear':
+        tq = t_latch + first_time
+        sampled = np.empty((len(t_latch), raw.shape[1]))
+        for c in xrange(raw.shape[1]):
+            sampled[:, c] = np.interp(tq, raw[:,0], raw[:,c])
+        return sampled, None
+    else:
+        raise ValueError("[E] unknown sampling method '{}'".format(method))
+
+def sample_signal(raw, start_time=None, dt=0.1, t_offset=0.0, verb=0,
+                  method='latch'):
     ''' given an irregular sampled dataset, sample at a more regular rate
     to produce a parallelly readable series. If start_time is given, use
     this as a reference time. Otherwise, assume the first element of the
     first column is the reference point.
 
+    method 'latch' holds the first sample at or after each step (zero-order
+    hold; the original behaviour); 'linear' interpolates between samples.
+
     '''
     # first compute the number of fields
     samples, cols = raw.shape
@@ -264,44 +694,47 @@ def sample_signal(raw, start_time=None, dt=0.1, t_offset=0.0, verb=0):
     # can also pre-calculate the overall length of data based on
     # dt, so long as we see what the max time - min time is.
     num_samples = int(np.ceil(float(max_time) / dt))
-    #print num_samples, cols
-    sampled = np.zeros((num_samples, cols) )
-    #latch = np.array(raw[0,:])
-
-    # then latch one sample per step
-    #t = -(0.9*dt) # internal progress
-    t = -dt # internal progress
-    i = 0
-    timesteps = np.zeros((num_samples,))
-    for tt in xrange(num_samples):
-    #for tt in xrange(100):
-        # have we gone past this sample? - if so, change mem
-
-        elapsed = raw[i, 0] - first_time
-        while elapsed < t:
-            if verb > 1:
-                print "moving past sample {} (t={}, elap={})".format(i, t, elapsed)
-                print "  looking for data that is later than {} (t_rel={})".format(
-                    raw[i, 0], raw[i, 0]-first_time )
-            i += 1
-            if i < raw.shape[0]:
-                elapsed = raw[i, 0] - first_time
-            else:
-                i -= 1
-                break
-        if verb > 1: print "t=", t
-        latched = np.array(raw[i, :])
-        t += dt
-        timesteps[tt] = t + t_offset
-        sampled[tt,:] = np.array(latched)
-
-        #if timesteps[tt] > 2750:
-        #    break
-
-    if verb: print "[I] sampled data, with %d rows, after %d moves and %d secs" % (tt, i, t)
+    t_latch, t_report = _sample_times(num_samples, dt)
+    sampled, idx = _sample_onto(raw, first_time, t_latch, method)
+    timesteps = t_report + t_offset
+
+    if verb and num_samples:
+        moves = idx[-1] if idx is not None else samples - 1
+        print "[I] sampled data, with %d rows, after %d moves and %d secs" % (
+            num_samples - 1, moves, t_report[-1])
 
     return sampled, timesteps
 
+def sample_signals(raws, start_time=None, stop_time=None, dt=0.1,
+                   t_offset=0.0, method='latch'):
+    '''
+    sample several irregular series (each with time in the first column)
+    onto one shared time grid, as sample_signal does for one series.
+
+    The grid runs from start_time (default: the earliest first time) to
+    stop_time (default: the latest last time).  Series that are None are
+    passed through as None.
+
+    returns a list of sampled arrays, and the timesteps of the shared grid.
+    '''
+    valid = [r for r in raws if r is not None]
+    if start_time is None:
+        start_time = min([r[0,0] for r in valid])
+    if stop_time is None:
+        stop_time = max([r[-1,0] for r in valid])
+
+    num_samples = int(np.ceil(float(stop_time - start_time) / dt))
+    t_latch, t_report = _sample_times(num_samples, dt)
+
+    sampled = []
+    for raw in raws:
+        if raw is None:
+            sampled.append(None)
+        else:
+            sampled.append(_sample_onto(raw, start_time, t_latch, method)[0])
+
+    return sampled, t_report + t_offset
+
 #}}}
 
 #{{{ support utils
@@ -0,0 +1,230 @@
+'''
+Rolling-window statistics over 1d or nd series, along one axis.
+
+All functions share the same window placement and edge handling.  A window
+of `w` samples at output i covers inputs i - w//2 .. i + (w-1)//2, which is
+centred for odd w, and is the placement of np.convolve(.., 'same').  The
+`edges` argument decides what happens where the window runs off the data:
+
+  'shrink'  use only the samples available (default)
+  'zero'    treat missing samples as zeros (as plg.movingaverage did)
+  'nan'     output NaN where the window is incomplete
+  'valid'   only output complete windows (length n - w + 1)
+
+sum/mean/std are O(n), using cumulative sums that are computed blockwise
+on mean-shifted data so that long float series don't lose precision; std
+re-centres each block, so its error scales with the spread in the window.
+min/max are O(n) with the van Herk / Gil-Werman block scan.  median is
+vectorised over a strided view, in chunks, so costs O(n.w) but in C.
+
+'''
+
+import numpy as np
+
+EDGE_MODES = ['shrink', 'zero', 'nan', 'valid']
+
+#{{{ helpers
+def _prep(data, window_size, axis, edges):
+    w = int(window_size)
+    if w < 1:
+        raise ValueError("[E] window size must be >= 1, not {}".format(w))
+    if edges not in EDGE_MODES:
+        raise ValueError("[E] unknown edge mode '{}' (use one of {})".format(
+            edges, EDGE_MODES))
+    d = np.moveaxis(np.asarray(data, dtype=float), axis, -1)
+    return d, w
+
+def _bounds(n, w):
+    ''' first and last+1 input index covered by each output window '''
+    i = np.arange(n)
+    lo = np.clip(i - w // 2, 0, n)
+    hi = np.clip(i + (w - 1) // 2 + 1, 0, n)
+    return lo, hi
+
+def stable_cumsum(d, block=4096):
+    '''
+    cumulative sum along the last axis, with a leading 0 (so the result
+    has n+1 entries and sum(d[a:b]) = cs[b] - cs[a]).
+
+    The sum is done within blocks, then the (fewer) block totals are
+    summed, which keeps rounding error at O(block + n/block) terms rather
+    than O(n) for a plain cumsum.
+    '''
+    n = d.shape[-1]
+    cs = np.zeros(d.shape[:-1] + (n + 1,))
+    if n == 0:
+        return cs
+    nb = -(-n // block)
+    pad = nb * block - n
+    if pad:
+        d = np.concatenate([d, np.zeros(d.shape[:-1] + (pad,))], axis=-1)
+    blocks = d.reshape(d.shape[:-1] + (nb, block))
+    within = np.cumsum(blocks, axis=-1)
+    offsets = np.zeros(d.shape[:-1] + (nb,))
+    np.cumsum(within[..., :-1, -1], axis=-1, out=offsets[..., 1:])
+    cs[..., 1:] = (within + offsets[..., None]).reshape(
+        d.shape[:-1] + (nb * block,))[..., :n]
+    return cs
+
+def _finish(out, d, w, lo, hi, edges, axis):
+    ''' apply 'nan' / 'valid' edge modes, and put the axis back '''
+    n = d.shape[-1]
+    if edges == 'nan':
+        out[..., (hi - lo) < w] = np.nan
+    elif edges == 'valid':
+        s = w // 2
+        out = out[..., s:s + max(n - w + 1, 0)]
+    return np.moveaxis(out, -1, axis)
+
+def _window_sums(d, w, lo, hi):
+    ''' per-window sums of d and the mean used to shift d '''
+    shift = d.mean(axis=-1, keepdims=True) if d.shape[-1] else 0.0
+    cs = stable_cumsum(d - shift)
+    return cs[..., hi] - cs[..., lo], shift
+
+def _window_sq_devs(d, w, lo, hi):
+    '''
+    per-window sums of squared deviations from the window mean.
+
+    d is cut into blocks of w, so each window is a suffix of one block (the
+    tail) and a prefix of the next (the head).  The running sums within a
+    block are taken relative to its last sample (for suffixes) and first
+    sample (for prefixes), i.e. to a sample inside each part, so rounding
+    error scales with the spread of the window, not of the series.
+    '''
+    n = d.shape[-1]
+    nb = -(-n // w)
+    shape = d.shape[:-1] + (nb * w,)
+    padded = np.empty(shape)
+    padded[..., :n] = d
+    padded[..., n:] = d[..., -1:]     # padding adds nothing to the suffixes
+    blocks = padded.reshape(d.shape[:-1] + (nb, w))
+    pre = blocks - blocks[..., :1]
+    suf = (blocks - blocks[..., -1:])[..., ::-1]
+    p1 = np.cumsum(pre, axis=-1).reshape(shape)
+    p2 = np.cumsum(pre ** 2, axis=-1).reshape(shape)
+    s1 = np.cumsum(suf, axis=-1)[..., ::-1].reshape(shape)
+    s2 = np.cumsum(suf ** 2, axis=-1)[..., ::-1].reshape(shape)
+
+    # tail lo..mid (empty if lo starts a block), head mid..hi
+    start = lo - lo % w
+    mid = np.where(lo == start, lo, np.minimum(start + w, n))
+    nt, nh = (mid - lo).astype(float), (hi - mid).astype(float)
+    t1 = np.where(nt > 0, s1[..., lo], 0.0)
+    t2 = np.where(nt > 0, s2[..., lo], 0.0)
+    h1 = np.where(nh > 0, p1[..., hi - 1], 0.0)
+    h2 = np.where(nh > 0, p2[..., hi - 1], 0.0)
+    mt, mh = np.maximum(nt, 1), np.maximum(nh, 1)
+    ss = (t2 - t1 ** 2 / mt) + (h2 - h1 ** 2 / mh)
+    # combine the two parts (Chan et al.); the difference of their means is
+    # taken as the difference of the reference samples plus that of the
+    # (small) mean offsets, which keeps it exact for nearby samples
+    delta = ((padded[..., np.minimum(mid, nb * w - 1)] -
+              padded[..., start + w - 1]) + (h1 / mh - t1 / mt))
+    both = (nt > 0) & (nh > 0)
+    ss += np.where(both, delta ** 2 * nt * nh / np.maximum(nt + nh, 1), 0.0)
+    # anything below the rounding noise of the window's own sums is a zero
+    ss[ss < 16 * np.finfo(float).eps * (t2 + h2)] = 0.0
+    return ss
+#}}}
+
+#{{{ sum / mean / std
+def rolling_sum(data, window_size, axis=-1, edges='shrink'):
+    '''
+    sum over each window.  With 'shrink' and 'zero', the missing samples
+    contribute nothing, so both give the same result.
+    '''
+    d, w = _prep(data, window_size, axis, edges)
+    lo, hi = _bounds(d.shape[-1], w)
+    s, shift = _window_sums(d, w, lo, hi)
+    out = s + shift * (hi - lo)
+    return _finish(out, d, w, lo, hi, edges, axis)
+
+def rolling_mean(data, window_size, axis=-1, edges='shrink'):
+    '''
+    mean over each window.  'zero' divides by the full window size (as
+    plg.movingaverage); 'shrink' divides by the samples available.
+    '''
+    d, w = _prep(data, window_size, axis, edges)
+    lo, hi = _bounds(d.shape[-1], w)
+    s, shift = _window_sums(d, w, lo, hi)
+    cnt = (hi - lo).astype(float)
+    if edges == 'zero':
+        out = (s + shift * cnt) / float(w)
+    else:
+        out = s / np.maximum(cnt, 1) + shift
+    return _finish(out, d, w, lo, hi, edges, axis)
+
+def rolling_std(data, window_size, axis=-1, edges='shrink', ddof=0):
+    '''
+    standard deviation over each window (of the samples available, for
+    'shrink' and 'zero' alike).
+    '''
+    d, w = _prep(data, window_size, axis, edges)
+    lo, hi = _bounds(d.shape[-1], w)
+    if d.shape[-1] == 0:
+        return _finish(np.zeros(d.shape), d, w, lo, hi, edges, axis)
+    ss = _window_sq_devs(d, w, lo, hi)
+    cnt = (hi - lo).astype(float)
+    out = np.sqrt(ss / np.maximum(cnt - ddof, 1))
+    return _finish(out, d, w, lo, hi, edges, axis)
+#}}}
+
+#{{{ min / max
+def _rolling_extreme(data, window_size, axis, edges, fn, fill):
+    d, w = _prep(data, window_size, axis, edges)
+    n = d.shape[-1]
+    lo, hi = _bounds(n, w)
+    # pad so every output has a full window, then run the block scan over
+    # the padded series: in blocks of w, a prefix scan and a suffix scan;
+    # the window starting at s is then fn(suffix[s], prefix[s + w - 1]).
+    edge_val = 0.0 if edges == 'zero' else fill
+    left, right = w // 2, (w - 1) // 2
+    m = n + left + right
+    nb = -(-m // w)
+    padded = np.full(d.shape[:-1] + (nb * w,), fill)
+    padded[..., :left] = edge_val
+    padded[..., left:left + n] = d
+    padded[..., left + n:m] = edge_val
+
+    blocks = padded.reshape(d.shape[:-1] + (nb, w))
+    prefix = fn.accumulate(blocks, axis=-1).reshape(padded.shape)
+    suffix = fn.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(
+        padded.shape)
+    s = np.arange(n)
+    out = fn(suffix[..., s], prefix[..., s + w - 1])
+    return _finish(out, d, w, lo, hi, edges, axis)
+
+def rolling_max(data, window_size, axis=-1, edges='shrink'):
+    ''' maximum over each window '''
+    return _rolling_extreme(data, window_size, axis, edges, np.maximum, -np.inf)
+
+def rolling_min(data, window_size, axis=-1, edges='shrink'):
+    ''' minimum over each window '''
+    return _rolling_extreme(data, window_size, axis, edges, np.minimum, np.inf)
+#}}}
+
+#{{{ median
+def rolling_median(data, window_size, axis=-1, edges='shrink', chunk=65536):
+    '''
+    median over each window; 'zero' counts missing samples as zeros.
+    '''
+    d, w = _prep(data, window_size, axis, edges)
+    n = d.shape[-1]
+    lo, hi = _bounds(n, w)
+    left, right = w // 2, (w - 1) // 2
+    edge_val = 0.0 if edges == 'zero' else np.nan
+    padded = np.full(d.shape[:-1] + (n + left + right,), edge_val)
+    padded[..., left:left + n] = d
+
+    st = padded.strides[-1]
+    out = np.empty(d.shape)
+    median = np.median if edges == 'zero' else np.nanmedian
+    for c in xrange(0, n, chunk):
+        k = min(chunk, n - c)
+        view = np.lib.stride_tricks.as_strided(
+            padded[..., c:], shape=d.shape[:-1] + (k, w),
+            strides=padded.strides[:-1] + (st, st))
+        out[..., c:c + k] = median(view, axis=-1)
+    return _finish(out, d, w, lo, hi, edges, axis)
+#}}}
@@ -0,0 +1,411 @@
+'''
+Re-runnable checks that the rewritten numerical routines agree with the
+straightforward versions they replace (the original loops, np.loadtxt,
+closed forms, brute-force counts).  Each check raises AssertionError on a
+mismatch.
+  $ python equivalence_checks.py            # all checks
+  $ python equivalence_checks.py sample_signal parse_records
+'''
+import os, sys
+import numpy as np
+
+from cbtb.logs import process_logs as plg
+
+#{{{ sample_signal
+def _sample_signal_loop(raw, first_time, num_samples, dt=0.1, t_offset=0.0):
+    ''' the original per-sample latch loop of plg.sample_signal '''
+    sampled = np.zeros((num_samples, raw.shape[1]))
+    timesteps = np.zeros((num_samples,))
+    t = -dt
+    i = 0
+    for tt in xrange(num_samples):
+        elapsed = raw[i, 0] - first_time
+        while elapsed < t:
+            i += 1
+            if i < raw.shape[0]:
+                elapsed = raw[i, 0] - first_time
+            else:
+                i -= 1
+                break
+        t += dt
+        timesteps[tt] = t + t_offset
+        sampled[tt,:] = raw[i, :]
+    return sampled, timesteps
+
+def _irregular(rs, n, monotonic=True, integer=False):
+    t = 1000.0 + np.cumsum(rs.uniform(0.01, 0.3, n))
+    if not monotonic:
+        t += rs.normal(0, 0.2, n)
+    v = rs.randint(0, 4000, (n, 3)) if integer else rs.randn(n, 3)
+    return np.column_stack((t, v))
+
+def check_sample_signal(reps=20, seed=1):
+    rs = np.random.RandomState(seed)
+    for r in xrange(reps):
+        raw = _irregular(rs, rs.randint(2, 2000), monotonic=r % 3 != 1,
+                         integer=r % 3 == 2)
+        dt = rs.choice([0.05, 0.1, 0.5, 1.0])
+        start = None if r % 2 else raw[0,0] - rs.uniform(0, 2)
+        s, ts = plg.sample_signal(raw, start_time=start, dt=dt, t_offset=0.5)
+        first = raw[0,0] if start is None else start
+        n = int(np.ceil(float(raw[-1,0] - first) / dt))
+        s0, ts0 = _sample_signal_loop(raw, first, n, dt=dt, t_offset=0.5)
+        assert np.array_equal(s, s0) and np.array_equal(ts, ts0)
+
+    # several series onto one grid
+    raws = [_irregular(rs, rs.randint(2, 500)) for _ in xrange(4)]
+    raws[1][:,0] += 3.0
+    ss, ts = plg.sample_signals(raws, dt=0.2)
+    first = min([r[0,0] for r in raws])
+    n = int(np.ceil(float(max([r[-1,0] for r in raws]) - first) / 0.2))
+    for raw, s in zip(raws, ss):
+        s0, ts0 = _sample_signal_loop(raw, first, n, dt=0.2)
+        assert np.array_equal(s, s0) and np.array_equal(ts, ts0)
+    print "[I] sample_signal, sample_signals == original loop"
+#}}}
+
+#{{{ parse_records
+def check_parse_records(n=20000):
+    import shutil, tempfile
+    from parse_benchmark import write_log
+    pth = tempfile.mkdtemp(prefix="cbtb-check-")
+    try:
+        write_log(pth, "casu-001", n)
+        series = plg.read_all_series("casu-001", pth)
+    finally:
+        shutil.rmtree(pth)
+
+    cases = [(series[key], cols) for key, cols in
+             [('ir', range(1,8)), ('temp', range(1,10)), ('pelt', (1,2,3))]]
+    # ragged records, newlines left on, exponents, one record, none
+    ir = series['ir'][:50]
+    ragged = [l + ";17;3" if i % 3 else l for i, l in enumerate(ir)]
+    cases += [(ragged, range(1,8)), ([l + "\n" for l in ir], (1, 4)),
+              (["temp;1.5e9;-2.5E-1;3"] * 3, (1,2,3)), (ir[:1], range(1,8))]
+    for lines, cols in cases:
+        a = np.loadtxt(lines, usecols=cols, delimiter=';')
+        for block in [65536, 7]:
+            b = plg.parse_records(lines, cols, block=block)
+            assert a.shape == b.shape and np.array_equal(a, b)
+    assert plg.parse_records([], range(1,8)).shape == (0, 7)
+    print "[I] parse_records == np.loadtxt"
+#}}}
+
+#{{{ chunked processing
+def _chunks(x, sizes):
+    ''' x cut into consecutive chunks of the given sizes (the last repeats) '''
+    out, i = [], 0
+    while i < len(x):
+        n = sizes[min(len(out), len(sizes) - 1)]
+        out.append(x[i:i + n])
+        i += n
+    return out
+
+def check_chunked(n=200, w=61):
+    from cbtb.logs import rolling
+    from cbtb.logs.chunked import ChunkedRollingMean
+    rs = np.random.RandomState(2)
+    for x in [np.arange(float(n)), rs.randn(n, 3)]:
+        for edges in ['zero', 'shrink']:
+            ref = rolling.rolling_mean(x, w, axis=0, edges=edges)
+            if edges == 'zero' and x.ndim == 1:
+                assert np.allclose(ref, plg.movingaverage(x, w))
+            for sizes in [[1], [7], [w // 2], [w], [n], [10, n], [3, 100]]:
+                ma = ChunkedRollingMean(w, edges=edges)
+                out = [ma.update(c) for c in _chunks(x, sizes)] + [ma.finish()]
+                out = np.concatenate(out)
+                assert out.shape == ref.shape, (edges, sizes, out.shape)
+                assert np.allclose(out, ref, rtol=0, atol=1e-9)
+    print "[I] ChunkedRollingMean == rolling_mean / movingaverage"
+
+def check_chunked_hits(n=20000):
+    import shutil, tempfile
+    from parse_benchmark import write_log
+    from cbtb.logs.casu_reader import SingleLogDataOwner
+    from cbtb.logs.chunked import chunked_hits
+    pth = tempfile.mkdtemp(prefix="cbtb-check-")
+    try:
+        write_log(pth, "casu-001", n)
+        sld = SingleLogDataOwner("casu-001", pth, cache=False)
+        sld.read_data()
+        sld.compute_thresh()
+        sld.compute_hits()
+        w, nch = sld.movavg_len, sld.nchannels
+        for chunksize in [3, 7, 1000]:
+            blks = list(chunked_hits("casu-001", pth, chunksize=chunksize,
+                                     nchannels=nch, movavg_len=w))
+            t = np.concatenate([b['t'] for b in blks])
+            hits = np.concatenate([b['hits'] for b in blks])
+            ma_hits = np.concatenate([b['ma_hits'] for b in blks])
+            assert np.array_equal(t, sld.data['ir'][:,0])
+            assert np.array_equal(hits, sld.data['hits'])
+            # zero-padded edges (as LogDataOwner); the same as the
+            # single owner's movavg2 away from the edges
+            ref = plg.movingaverage(hits, w) / float(nch)
+            assert np.allclose(ma_hits, ref, rtol=0, atol=1e-12)
+            mid = slice(w // 2, len(hits) - (w - 1) // 2)
+            assert np.allclose(ma_hits[mid], sld.data['ma_hits'][mid],
+                               rtol=0, atol=1e-12)
+    finally:
+        shutil.rmtree(pth)
+    print "[I] chunked_hits == SingleLogDataOwner.compute_hits"
+#}}}
+
+#{{{ rolling statistics
+def _rolling_brute(x, w, fn):
+    ''' fn over each window (the placement of rolling.py), shrinking '''
+    n = x.shape[-1]
+    out = np.zeros(x.shape)
+    for i in xrange(n):
+        lo, hi = max(i - w // 2, 0), min(i + (w - 1) // 2 + 1, n)
+        out[..., i] = fn(x[..., lo:hi], axis=-1)
+    return out
+
+def check_rolling(n=300):
+    from cbtb.logs import rolling
+    rs = np.random.RandomState(4)
+    # nonstationary: a ramp of std ~3e-5 after a step of 1e8
+    step = np.concatenate([np.zeros(n // 2), 1e8 + 1e-5 * np.arange(n - n // 2)])
+    series = [rs.randn(n), 1e6 + rs.randn(2, n), np.full(n, 3.7), step,
+              np.cumsum(rs.randn(n)) * 1e4, rs.randn(5)]
+    fns = [(rolling.rolling_mean, np.mean), (rolling.rolling_sum, np.sum),
+           (rolling.rolling_std, np.std), (rolling.rolling_min, np.min),
+           (rolling.rolling_max, np.max), (rolling.rolling_median, np.median)]
+    for x in series:
+        for w in [1, 2, 11, 64, 1000]:
+            for fn, ref_fn in fns:
+                ref = _rolling_brute(x, w, ref_fn)
+                out = fn(x, w)
+                if ref_fn is np.std:
+                    # np.std itself rounds in x - mean; centre each window
+                    # on one of its samples first
+                    ref = _rolling_brute(x, w, lambda v, axis: np.std(
+                        v - v[..., :1], axis=axis))
+                atol = 1e-7 * np.abs(x).max() if ref_fn in [np.mean, np.sum] else 0
+                assert np.allclose(out, ref, rtol=1e-7, atol=atol), (fn, w)
+                v = fn(x, w, edges='valid')
+                assert np.array_equal(v, out[..., w // 2:w // 2 + v.shape[-1]])
+            if x.ndim == 1 and x[0] == x[-1]:
+                assert not rolling.rolling_std(x, w).any()
+    x = np.concatenate([np.zeros(50), 1e8 + 1e-5 * np.arange(50)])
+    assert np.allclose(rolling.rolling_std(x, 11)[60:95],
+                       [np.std(x[i - 5:i + 6] - x[i]) for i in xrange(60, 95)],
+                       rtol=1e-9)
+    print "[I] rolling sum/mean/std/min/max/median == brute force"
+#}}}
+
+#{{{ information theory estimators
+def _resid_var(regressors, y):
+    ''' variance of the OLS residuals of y on the regressors (and a constant) '''
+    M = np.column_stack([np.ones(len(y))] + regressors)
+    beta = np.linalg.lstsq(M, y, rcond=None)[0]
+    return np.var(y - M.dot(beta))
+
+def _coupled(rs, N, lag=2):
+    ''' x driven by its own past and by y, `lag` steps earlier '''
+    y = rs.randn(N)
+    x = np.zeros(N)
+    for t in xrange(lag, N):
+        x[t] = 0.5 * x[t-1] - 0.2 * x[t-2] + 0.4 * y[t-lag] + rs.randn()
+    return y, x
+
+def check_gaussian(N=5000):
+    from cbtb.info_theory import estimators as est
+    rs = np.random.RandomState(3)
+    # MI: -1/2 ln(1 - r^2)
+    a = rs.randn(N)
+    b = 0.6 * a + rs.randn(N)
+    r = np.corrcoef(a, b)[0,1]
+    mi = est.MutualInfoCalculatorGaussian()
+    mi.setObservations(a, b)
+    assert np.allclose(mi.computeAverageLocalOfObservations(), -0.5 * np.log(1 - r*r))
+
+    # TE with delay u, histories k, l: 1/2 ln of the ratio of residual
+    # variances of x_{t+1} regressed on its past, without and with y's past
+    y, x = _coupled(rs, N)
+    for (k, l, u) in [(1, 1, 2), (2, 1, 2), (2, 2, 1), (1, 3, 3)]:
+        te = est.TransferEntropyCalculatorGaussian()
+        te.initialise(k, 1, l, 1, u)
+        te.setObservations(y, x)
+        first = max(k - 1, l - 1 + u - 1)
+        t = np.arange(first, N - 1)
+        xp = [x[t - i] for i in xrange(k)]
+        yp = [y[t + 1 - u - i] for i in xrange(l)]
+        ref = 0.5 * np.log(_resid_var(xp, x[t + 1]) / _resid_var(xp + yp, x[t + 1]))
+        assert te.getNumObservations() == len(t)
+        assert np.allclose(te.computeAverageLocalOfObservations(), ref, rtol=1e-9)
+
+        # the fast permutation surrogates against recomputing from scratch
+        perms = [te.rs.permutation(len(t)) for _ in xrange(5)]
+        slow = est._Calculator._surrogates(te, perms)
+        assert np.allclose(te._surrogates(perms), slow, rtol=1e-9)
+
+    # an ensemble is pooled, with no observations across series boundaries
+    te = est.TransferEntropyCalculatorGaussian()
+    te.initialise(1, 1, 1, 1, 2)
+    te.startAddObservations()
+    for i in xrange(0, N, 500):
+        te.addObservations(y[i:i+500], x[i:i+500])
+    te.finaliseAddObservations()
+    assert te.getNumObservations() == (N // 500) * (500 - 2)
+    print "[I] Gaussian MI / TE == closed forms"
+
+def _maxdist(X):
+    ''' all pairwise max-norm distances '''
+    if X.shape[1] == 0:
+        return np.zeros((len(X), len(X)))
+    return np.abs(X[:, None, :] - X[None, :, :]).max(axis=2)
+
+def _ksg_brute(A, B, C, k, alg):
+    ''' KSG I(A;B|C) with O(N^2) neighbour counts, from the definitions '''
+    from scipy.special import digamma
+    N = len(A)
+    DJ = _maxdist(np.hstack((A, B, C)))
+    DA, DB, DC = _maxdist(A), _maxdist(B), _maxdist(C)
+    np.fill_diagonal(DJ, np.inf)
+    others = ~np.eye(N, dtype=bool)
+    nn = np.argsort(DJ, axis=1, kind='mergesort')[:, :k]
+    rows = np.arange(N)[:, None]
+    cond = C.shape[1] > 0
+    if alg == 1:
+        eps = DJ[rows, nn[:, -1:]]
+        cnt = lambda D: ((D < eps) & others).sum(axis=1)
+        if not cond:
+            return (digamma(k) + digamma(N)
+                    - np.mean(digamma(cnt(DA) + 1) + digamma(cnt(DB) + 1)))
+        return digamma(k) - np.mean(digamma(cnt(np.maximum(DA, DC)) + 1)
+                                    + digamma(cnt(np.maximum(DB, DC)) + 1)
+                                    - digamma(cnt(DC) + 1))
+    ea, eb = DA[rows, nn].max(axis=1)[:, None], DB[rows, nn].max(axis=1)[:, None]
+    if not cond:
+        na = ((DA <= ea) & others).sum(axis=1)
+        nb = ((DB <= eb) & others).sum(axis=1)
+        return digamma(k) - 1.0 / k + digamma(N) - np.mean(digamma(na) + digamma(nb))
+    ec = DC[rows, nn].max(axis=1)[:, None]
+    in_c = (DC <= ec) & others
+    nc, nac, nbc = in_c.sum(1), (in_c & (DA <= ea)).sum(1), (in_c & (DB <= eb)).sum(1)
+    return digamma(k) - 2.0 / k + np.mean(digamma(nc) - digamma(nac) - digamma(nbc)
+                                          + 1.0 / nac + 1.0 / nbc)
+
+def check_ksg(N=400):
+    from cbtb.info_theory import estimators as est
+    rs = np.random.RandomState(4)
+    # neighbour counts, with ties (integer data, no noise) and radii that
+    # are exactly some of the distances
+    for strict in [True, False]:
+        for X in [rs.randn(N, 1), rs.randint(0, 6, (N, 1)).astype(float),
+                  rs.randn(N, 2), rs.randint(0, 4, (N, 3)).astype(float)]:
+            r = np.abs(X - X[rs.randint(0, N, N)]).max(axis=1)
+            r[::3] = np.abs(rs.randn(len(r[::3])))
+            D = _maxdist(X)
+            ref = (((D < r[:, None]) if strict else (D <= r[:, None]))
+                   & ~np.eye(N, dtype=bool)).sum(axis=1)
+            assert np.array_equal(est._count(X, r, strict, 1), ref)
+
+    # the estimators, with and without conditioning
+    A = rs.randn(N, 1)
+    B = 0.7 * A + rs.randn(N, 1)
+    C = rs.randn(N, 2)
+    B[:, 0] += C[:, 0]
+    for alg in [1, 2]:
+        for CC in [C[:, :0], C[:, :1], C]:
+            for k in [1, 4]:
+                assert np.allclose(est._ksg_cmi(A, B, CC, k, alg, 1),
+                                   _ksg_brute(A, B, CC, k, alg), rtol=1e-12)
+
+    # through the calculator, on count data as in the bee ensembles
+    y, x = _coupled(rs, N)
+    y, x = np.round(2 * y), np.round(x)
+    for alg in ['1', '2']:
+        te = est.TransferEntropyCalculatorKraskov(seed=0)
+        te.setProperty("ALG_NUM", alg)
+        te.setProperty("DELAY", "2")
+        te.setObservations(y, x)
+        assert np.allclose(te.computeAverageLocalOfObservations(),
+                           _ksg_brute(te.A, te.B, te.C, 4, int(alg)), rtol=1e-12)
+    # and without the noise, i.e. with exact ties (only algorithm 1 is
+    # defined then: algorithm 2 depends on which tied neighbours are taken)
+    te.setProperty("ALG_NUM", "1")
+    te.setProperty("NOISE_LEVEL_TO_ADD", "0")
+    te.setObservations(y, x)
+    assert np.allclose(te.computeAverageLocalOfObservations(),
+                       _ksg_brute(te.A, te.B, te.C, 4, 1), rtol=1e-12)
+    print "[I] KSG counts / estimates == brute force"
+#}}}
+
+#{{{ batch loading
+def _write_project(root, casus, n, seed):
+    ''' an experiment dir as LogDataOwner expects, one layer '''
+    from parse_benchmark import write_log
+    dep = os.path.join(root, 'archive', 'dep')
+    os.makedirs(dep)
+    with open(os.path.join(dep, 'exp.assisi'), 'w') as f:
+        f.write("arena: exp.arena\n")
+    with open(os.path.join(dep, 'exp.arena'), 'w') as f:
+        f.write("layer-a:\n")
+        for c in casus:
+            f.write("  {}: {{}}\n".format(c))
+    for j, c in enumerate(casus):
+        pth = os.path.join(root, 'data_exp', 'layer-a', c)
+        os.makedirs(pth)
+        fn = write_log(pth, c, n, seed=seed + j)
+        t = float(open(fn).readline().split(';')[1])
+        with open(os.path.join(pth, "{}-2017.sync.log".format(c)), 'w') as f:
+            for k in xrange(3):
+                f.write("{:.3f};{};flash;start\n".format(t + 10 * k, k))
+
+def check_batch_fds(nexp=6, nfile=64):
+    '''
+    load more mapped arrays than RLIMIT_NOFILE allows open; the set must
+    cap its maps and match a serial load
+    '''
+    import shutil, tempfile, resource
+    from cbtb.logs import casu_reader
+    from cbtb.logs.batch import ExperimentSet
+    casus = ['casu-00{}'.format(j) for j in xrange(1, 7)]
+    base = tempfile.mkdtemp(prefix="cbtb-check-")
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    mmap_min = casu_reader.MMAP_MIN_BYTES
+    try:
+        for e in xrange(nexp):
+            _write_project(os.path.join(base, 'exp', 'run{}'.format(e)),
+                           casus, 500, seed=10 * e)
+        specs = [{'base': 'exp', 'label': 'run{}'.format(e)}
+                 for e in xrange(nexp)]
+        kw = dict(grp_base=base, shared_spec={'casus': casus}, cache=False)
+        ref = ExperimentSet(specs, **kw).load()
+        casu_reader.MMAP_MIN_BYTES = 0      # map every array
+        resource.setrlimit(resource.RLIMIT_NOFILE, (nfile, limit[1]))
+        es = ExperimentSet(specs, workers=2, **kw).load()
+        assert len(es) == nexp and not es.failed, es.failed
+        nmaps = 0
+        for o, o0 in zip(es, ref):
+            for node, d in o.nodes.items():
+                for k, v in d.items():
+                    if isinstance(v, np.ndarray):
+                        assert np.array_equal(v, o0.nodes[node][k]), (node, k)
+                        nmaps += isinstance(v, np.memmap)
+        assert 0 < nmaps <= es.max_maps < nexp * len(casus) * 3
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limit)
+        casu_reader.MMAP_MIN_BYTES = mmap_min
+        shutil.rmtree(base)
+    print "[I] ExperimentSet under RLIMIT_NOFILE={} == serial load".format(nfile)
+#}}}
+
+CHECKS = [
+    ('sample_signal', check_sample_signal),
+    ('parse_records', check_parse_records),
+    ('rolling', check_rolling),
+    ('chunked', check_chunked),
+    ('chunked_hits', check_chunked_hits),
+    ('gaussian', check_gaussian),
+    ('ksg', check_ksg),
+    ('batch_fds', check_batch_fds),
+]
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or [name for (name, fn) in CHECKS]
+    for name, fn in CHECKS:
+        if name in names:
+            fn()
@@ -0,0 +1,64 @@
+'''
+Compare np.loadtxt against process_logs.parse_records on a synthetic casu
+log, for each record type; and the full SingleLogDataOwner.read_data with
+the legacy per-field readers against the single-pass reader.
+
+Values must be identical; the timings show the speed-up.
+  $ python parse_benchmark.py [num_lines]
+'''
+import os, sys, time, shutil, tempfile
+import numpy as np
+
+from cbtb.logs import process_logs as plg
+from cbtb.logs import casu_reader
+
+def write_log(pth, cname, n, seed=1):
+    ''' a log with the record mix and layouts of a phys casu '''
+    rs = np.random.RandomState(seed)
+    t = 1493632800.0 + np.cumsum(rs.uniform(0.02, 0.12, n))
+    kind = rs.rand(n)
+    fn = os.path.join(pth, "2017-05-01-10-00-00-{}.csv".format(cname))
+    with open(fn, 'w') as f:
+        for i in xrange(n):
+            if kind[i] < 0.6:
+                f.write("ir_raw;{:.4f};{}\n".format(t[i], ";".join(
+                    [str(v) for v in rs.randint(100, 4000, 7)])))
+            elif kind[i] < 0.9:
+                f.write("temp;{:.4f};{}\n".format(t[i], ";".join(
+                    ["{:.2f}".format(v) for v in rs.uniform(25, 36, 9)])))
+            else:
+                f.write("Peltier;{:.4f};{:.1f};1\n".format(t[i], rs.uniform(26, 36)))
+    return fn
+
+def timeit(fn, *args, **kwargs):
+    t0 = time.time()
+    r = fn(*args, **kwargs)
+    return r, time.time() - t0
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    pth = tempfile.mkdtemp(prefix="cbtb-bench-")
+    try:
+        write_log(pth, "casu-001", n)
+        series = plg.read_all_series("casu-001", pth)
+
+        print "\n=======\nparsing only ({} log lines)".format(n)
+        for key, cols in [('ir', range(1,8)), ('temp', range(1,10)),
+                          ('pelt', (1,2,3))]:
+            a, t_lt = timeit(np.loadtxt, series[key], usecols=cols, delimiter=';')
+            b, t_pr = timeit(plg.parse_records, series[key], cols)
+            assert np.array_equal(a, b)
+            print "{:5} {:7} rows  loadtxt {:6.3f}s  parse_records {:6.3f}s  ({:.1f}x)".format(
+                key, len(series[key]), t_lt, t_pr, t_lt / t_pr)
+
+        print "\n=======\nSingleLogDataOwner.read_data"
+        old = casu_reader.SingleLogDataOwner("casu-001", pth, cache=False)
+        _, t_old = timeit(old.read_data, single_pass=False)
+        new = casu_reader.SingleLogDataOwner("casu-001", pth, cache=False)
+        _, t_new = timeit(new.read_data)
+        for k in ['ir', 'temps', 'pelt']:
+            assert np.array_equal(old.data[k], new.data[k])
+        print "legacy {:.3f}s  single pass {:.3f}s  ({:.1f}x)".format(
+            t_old, t_new, t_old / t_new)
+    finally:
+        shutil.rmtree(pth)
@@ -30,7 +30,7 @@ def volatility(X, n):
 
 def _volatility_onefunc(X,n):
     ''' explicit form above; this does the same thing but harder to read! '''
-    return np.abs(np.ediff1d(X)).sum() / float(n * len(X)-1)
+    return np.abs(np.ediff1d(X)).sum() / (float(n) * (len(X)-1))
 
 
 # define some examples